@@ -1,48 +1,575 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, stream_with_context, g, has_request_context
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
-import google.generativeai as genai
-import PyPDF2
 import re
 from dotenv import load_dotenv
 load_dotenv()
 import os
+import sys
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import time
-from flask_session import Session
+import hashlib
+import struct
+import threading
+import random
+import secrets
+import socket
+import json
+import unicodedata
+import itertools
+import multiprocessing
+import queue
+import mmap
+import shutil
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from sqlalchemy.sql import text
-import pandas as pd
-from io import BytesIO
+from sqlalchemy.exc import IntegrityError, DBAPIError
+import csv
+import zlib
+from io import StringIO
 from werkzeug.utils import secure_filename
+from pdf_extract import extract_page_range
+try:
+    import fcntl  # khóa file giữa các worker (không có trên Windows)
+except ImportError:
+    fcntl = None
 # ================== CẤU HÌNH & KHỞI TẠO ==================
+# MODEL_BACKEND: "gemini" (mặc định) hoặc "fake" (backend giả lập cục bộ cho benchmark/dev, xem FakeBackend)
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'gemini')
 api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
+if MODEL_BACKEND == 'gemini' and not api_key:
     raise ValueError("❌ Không tìm thấy GEMINI_API_KEY trong biến môi trường!")
 
-genai.configure(api_key=api_key)
+# google.generativeai (~0.4s) và PyPDF2 chỉ được import khi dùng lần đầu (xem get_genai)
+_GENAI = None
+_GENAI_LOCK = threading.Lock()
+# GEMINI_TRANSPORT: "grpc" (mặc định của genai) hoặc "rest". Trong worker gevent mặc định là
+# "rest": socket đã được monkey-patch nên HTTP nhường chỗ cho greenlet khác, còn gRPC thì không.
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT')
+
+def gevent_patched():
+    # True khi chạy trong worker gevent của gunicorn (xem gunicorn.conf.py)
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('socket'))
+
+def cooperative_yield():
+    # Trong worker gevent, nhường event loop giữa các bước CPU dài (đọc PDF, tách từ BM25) để
+    # greenlet khác và heartbeat của gunicorn vẫn chạy; time.sleep đã được monkey-patch
+    if gevent_patched():
+        time.sleep(0)
+
+def get_genai():
+    global _GENAI
+    if _GENAI is None:
+        with _GENAI_LOCK:
+            if _GENAI is None:
+                import google.generativeai as genai
+                genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT or ('rest' if gevent_patched() else None))
+                _GENAI = genai
+    return _GENAI
 
 GENERATION_MODEL = 'gemini-2.5-flash-lite'
 EMBEDDING_MODEL = 'text-embedding-004'
+# Phần hướng dẫn tĩnh của prompt (system instruction) có thể được lưu thành context cache của
+# Gemini và dùng lại giữa các request (tính phí token rẻ hơn). Tắt mặc định vì cache cần đủ số
+# token tối thiểu và mỗi tiến trình worker giữ một cache riêng. Khi tắt, system instruction
+# vẫn đứng đầu mọi request, nên Gemini 2.5 có thể cache ngầm phần tiền tố giống nhau này.
+GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', '0') == '1'
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', 3600))
+
+# ================== BACKEND MÔ HÌNH ==================
+# Mọi lời gọi mô hình (nhúng, sinh câu trả lời, sinh dạng stream) đi qua MODEL,
+# nên có thể thay Gemini bằng FakeBackend mà không đổi phần còn lại của app.
+# timeout: hạn chót (giây) của cả lời gọi, kể cả khi stream.
+# system: phần hướng dẫn tĩnh, giống nhau giữa các request (xem TUTOR_SYSTEM_INSTRUCTION).
+class GeminiBackend:
+    name = 'gemini'
+
+    def __init__(self):
+        # Mỗi tiến trình giữ một GenerativeModel cho mỗi system instruction, dùng chung kết nối
+        # gRPC của genai, thay vì tạo mới ở mỗi request. Khóa theo pid vì kênh gRPC không
+        # dùng lại được sau fork.
+        self._models = {}  # (pid, system) -> (GenerativeModel, hạn dùng theo monotonic)
+        self._lock = threading.Lock()
+
+    def model(self, system=None):
+        key = (os.getpid(), system)
+        entry = self._models.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is None or entry[1] <= time.monotonic():
+                    entry = self._models[key] = self._create_model(system)
+        return entry[0]
+
+    def _create_model(self, system):
+        genai = get_genai()
+        if system and GEMINI_CONTEXT_CACHE:
+            try:
+                cache = genai.caching.CachedContent.create(
+                    model=f'models/{GENERATION_MODEL}', system_instruction=system,
+                    ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL))
+                print(f"✅ Đã tạo context cache {cache.name} cho system instruction")
+                # Tạo cache mới trước khi cache cũ hết hạn trên server
+                return genai.GenerativeModel.from_cached_content(cache), time.monotonic() + GEMINI_CONTEXT_CACHE_TTL * 0.9
+            except Exception as e:
+                print(f"⚠️ Không tạo được context cache, dùng system instruction thường: {e}")
+        return genai.GenerativeModel(GENERATION_MODEL, system_instruction=system), float('inf')
+
+    def embed(self, texts, model_name, timeout=None):
+        return get_genai().embed_content(model=model_name, content=texts,
+                                         request_options={'timeout': timeout})["embedding"]
+
+    def generate(self, prompt, timeout=None, system=None):
+        return self.model(system).generate_content(prompt, request_options={'timeout': timeout}).text
+
+    def generate_stream(self, prompt, timeout=None, system=None):
+        for piece in self.model(system).generate_content(prompt, stream=True, request_options={'timeout': timeout}):
+            yield piece.text
+
+class FakeBackendError(RuntimeError):
+    code = 503  # được tính như lỗi quá tải của upstream (xem is_overload_error)
+
+class FakeBackend:
+    # Backend giả lập, xác định (cùng seed -> cùng kết quả), không tốn quota:
+    # - embed: feature hashing theo từ, nên câu có nhiều từ chung cho vector gần nhau
+    # - generate: câu trả lời mẫu (có định dạng "Cấp độ/Lý do" khi prompt là prompt đánh giá)
+    # - độ trễ và tỉ lệ lỗi cấu hình được (FAKE_* trong biến môi trường)
+    name = 'fake'
+    ANSWER = ("Chào con! Ta cùng xem lại **Tam giác** nhé.\n"
+              "* Bước 1: Viết $a^2 + b^2 = c^2$ cho tam giác vuông.\n"
+              "* Bước 2: Thay số rồi tính *cẩn thận*.\n"
+              "Con thử làm bài tương tự với **Số hữu tỉ** nhé!")
+
+    def __init__(self, dim=None, embed_latency=None, per_item_latency=None, generate_latency=None,
+                 stream_chunks=None, failure_rate=None, seed=None):
+        env = os.getenv
+        self.dim = dim or int(env('FAKE_EMBED_DIM', 768))
+        self.embed_latency = embed_latency if embed_latency is not None else float(env('FAKE_EMBED_LATENCY', 0.05))
+        self.per_item_latency = per_item_latency if per_item_latency is not None else float(env('FAKE_EMBED_ITEM_LATENCY', 0.0005))
+        self.generate_latency = generate_latency if generate_latency is not None else float(env('FAKE_GENERATE_LATENCY', 0.8))
+        self.stream_chunks = stream_chunks or int(env('FAKE_STREAM_CHUNKS', 12))
+        self.failure_rate = failure_rate if failure_rate is not None else float(env('FAKE_FAILURE_RATE', 0))
+        self._rng = random.Random(seed if seed is not None else int(env('FAKE_SEED', 0)))
+        self._lock = threading.Lock()
+        self.calls = {'embed': 0, 'generate': 0, 'failures': 0, 'prompt_chars': 0}
+
+    def _call(self, kind, latency, timeout=None):
+        timed_out = timeout is not None and latency > timeout
+        with self._lock:
+            self.calls[kind] += 1
+            failed = timed_out or self._rng.random() < self.failure_rate
+            if failed:
+                self.calls['failures'] += 1
+        if timed_out:
+            time.sleep(timeout)
+            raise TimeoutError(f"Quá hạn {timeout}s ({kind})")
+        if latency > 0:
+            time.sleep(latency)
+        if failed:
+            raise FakeBackendError(f"Lỗi giả lập ({kind})")
+
+    def vector(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vec[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return vec
+
+    def embed(self, texts, model_name, timeout=None):
+        self._call('embed', self.embed_latency + self.per_item_latency * len(texts), timeout)
+        return [self.vector(t).tolist() for t in texts]
+
+    def _answer(self, prompt):
+        if 'Cấp độ:' in prompt:
+            return "Cấp độ: Khá\nLý do: Học sinh hỏi đều đặn, nắm được kiến thức cơ bản."
+        return self.ANSWER
+
+    def _count_prompt(self, prompt):
+        # Chỉ đếm phần thay đổi theo request (system instruction được cache phía server)
+        with self._lock:
+            self.calls['prompt_chars'] += len(prompt)
+
+    def generate(self, prompt, timeout=None, system=None):
+        self._count_prompt(prompt)
+        self._call('generate', self.generate_latency, timeout)
+        return self._answer(prompt)
+
+    def generate_stream(self, prompt, timeout=None, system=None):
+        # Độ trễ chia đều: một phần trước token đầu, phần còn lại rải theo các mảnh
+        text = self._answer(prompt)
+        first = self.generate_latency / 4
+        self._count_prompt(prompt)
+        self._call('generate', first, timeout)
+        size = max(1, -(-len(text) // self.stream_chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        for piece in pieces:
+            time.sleep((self.generate_latency - first) / len(pieces))
+            yield piece
+
+MODEL_BACKENDS = {'gemini': GeminiBackend, 'fake': FakeBackend}
+if MODEL_BACKEND not in MODEL_BACKENDS:
+    raise ValueError(f"❌ MODEL_BACKEND không hợp lệ: {MODEL_BACKEND} (chọn {', '.join(MODEL_BACKENDS)})")
+MODEL = MODEL_BACKENDS[MODEL_BACKEND]()
+
+# ================== GỌI MÔ HÌNH: GIỚI HẠN ĐỒNG THỜI & NGẮT MẠCH ==================
+# Code của app gọi MODEL_CLIENT thay vì gọi MODEL trực tiếp. "embed" và "generate" có bộ
+# giới hạn riêng vì quota của chúng tách nhau. Mỗi bộ gồm:
+# - hạn chót cho từng lời gọi (MODEL_TIMEOUT, MODEL_STREAM_TIMEOUT), truyền xuống backend
+# - AdaptiveLimiter: số lời gọi đồng thời tự điều chỉnh kiểu AIMD. Thành công khi đang dùng hết
+#   chỗ thì tăng 1/limit (trước lỗi quá tải đầu tiên thì tăng 1, tức gấp đôi sau mỗi lượt như
+#   slow start của TCP, để worker gevent nhanh chóng đạt hàng trăm lời gọi song song), còn
+#   429/5xx/quá hạn thì chia đôi. Hết chỗ thì chỉ chờ
+#   MODEL_QUEUE_TIMEOUT rồi báo bận, để luồng worker không dồn lại sau upstream đang chậm.
+# - CircuitBreaker: sau MODEL_BREAKER_FAILURES lỗi quá tải liên tiếp thì mở mạch trong
+#   MODEL_BREAKER_COOLDOWN giây. Khi mạch mở, lời gọi thất bại ngay, nên /chat trả câu
+#   "Thầy Gemini hơi mệt..." và nhúng câu hỏi chuyển sang BM25. Hết thời gian thì cho đúng
+#   một lời gọi thử; thử thành công mới đóng mạch.
+# Đường request không backoff/sleep; chỉ việc nền (dựng chỉ mục, đánh giá) mới thử lại có chờ.
+# Nhúng hàng loạt khi dựng chỉ mục/upload gọi với background=True: chờ tới khi có chỗ (không
+# báo bận sau MODEL_QUEUE_TIMEOUT) và khi mạch mở thì ngủ tới hết MODEL_BREAKER_COOLDOWN rồi
+# mới gọi, để một đợt 429 ngắn không làm hết số lần thử lại của cả lần dựng chỉ mục.
+MODEL_TIMEOUT = float(os.getenv('MODEL_TIMEOUT', 20))
+MODEL_STREAM_TIMEOUT = float(os.getenv('MODEL_STREAM_TIMEOUT', 60))
+MODEL_QUEUE_TIMEOUT = float(os.getenv('MODEL_QUEUE_TIMEOUT', 0.5))
+MODEL_INITIAL_CONCURRENCY = int(os.getenv('MODEL_INITIAL_CONCURRENCY', 8))
+MODEL_MAX_CONCURRENCY = int(os.getenv('MODEL_MAX_CONCURRENCY', 256))
+MODEL_MIN_CONCURRENCY = 1
+MODEL_BREAKER_FAILURES = int(os.getenv('MODEL_BREAKER_FAILURES', 5))
+MODEL_BREAKER_COOLDOWN = float(os.getenv('MODEL_BREAKER_COOLDOWN', 15))
+OVERLOAD_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class ModelUnavailableError(RuntimeError):
+    # App từ chối ngay và chưa gọi upstream (mạch đang mở hoặc hết chỗ đồng thời)
+    pass
+
+def is_overload_error(e):
+    # google.api_core: ResourceExhausted.code == 429, ServiceUnavailable == 503, DeadlineExceeded == 504
+    return isinstance(e, TimeoutError) or getattr(e, 'code', None) in OVERLOAD_STATUS_CODES
+
+class AdaptiveLimiter:
+    def __init__(self, initial, minimum, maximum, drop_interval=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.drop_interval = drop_interval  # một đợt lỗi dồn dập chỉ làm giảm một lần
+        self.dropped_at = float('-inf')
+        self.slow_start = True
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout):
+        # timeout None: chờ tới khi có chỗ
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.inflight += 1
+            return True
+
+    def release(self, outcome):
+        # outcome: 'ok' -> tăng cộng, 'overload' -> giảm nhân, còn lại giữ nguyên
+        with self.cond:
+            saturated = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            now = time.monotonic()
+            if outcome == 'ok' and saturated:
+                self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            elif outcome == 'overload' and now - self.dropped_at >= self.drop_interval:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.dropped_at = now
+                self.slow_start = False
+            self.cond.notify_all()
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def retry_after(self):
+        # Số giây còn lại tới khi mạch cho lời gọi thử (0 khi mạch đóng hoặc đã hết thời gian mở)
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, outcome, name):
+        # outcome None: lời gọi bị hủy giữa chừng (client ngắt stream), không tính
+        with self.lock:
+            if outcome == 'overload':
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.threshold:
+                    if self.opened_at is None:
+                        print(f"🔌 Ngắt mạch {name} sau {self.failures} lỗi liên tiếp, thử lại sau {self.cooldown:.0f}s")
+                    self.opened_at = time.monotonic()
+            elif outcome is not None:
+                if self.opened_at is not None:
+                    print(f"✅ Đóng mạch {name}: upstream đã phản hồi bình thường")
+                self.failures = 0
+                self.opened_at = None
+            self.probing = False
+
+class ModelGuard:
+    def __init__(self, kind):
+        self.kind = kind
+        self.limiter = AdaptiveLimiter(MODEL_INITIAL_CONCURRENCY, MODEL_MIN_CONCURRENCY, MODEL_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(MODEL_BREAKER_FAILURES, MODEL_BREAKER_COOLDOWN)
+
+    @contextmanager
+    def slot(self, background=False):
+        while True:
+            if not self.limiter.acquire(None if background else MODEL_QUEUE_TIMEOUT):
+                MODEL_CALLS.inc(self.kind, 'throttled')
+                raise ModelUnavailableError(f"Quá nhiều lời gọi {self.kind} đang chờ upstream")
+            if self.breaker.allow():
+                break
+            self.limiter.release(None)
+            if not background:
+                MODEL_CALLS.inc(self.kind, 'circuit_open')
+                raise ModelUnavailableError(f"Mạch {self.kind} đang mở, bỏ qua lời gọi")
+            # Không giữ chỗ trong lúc chờ; mạch nửa mở (đang có lời gọi thử) thì hỏi lại sau ít lâu
+            wait = self.breaker.retry_after()
+            if wait > 0:
+                print(f"⏳ Mạch {self.kind} đang mở, chờ {wait:.1f}s rồi gọi tiếp")
+            time.sleep(max(wait, 0.1))
+        outcome = 'ok'
+        try:
+            yield
+        except GeneratorExit:
+            outcome = None
+            raise
+        except BaseException as e:
+            outcome = 'overload' if is_overload_error(e) else 'error'
+            raise
+        finally:
+            self.limiter.release(outcome)
+            self.breaker.record(outcome, self.kind)
+            MODEL_CALLS.inc(self.kind, outcome or 'cancelled')
+
+class ModelClient:
+    # Đọc MODEL lúc gọi, nên benchmark/dev có thể thay backend (app.MODEL = FakeBackend(...))
+    def __init__(self):
+        self.guards = {'embed': ModelGuard('embed'), 'generate': ModelGuard('generate')}
+
+    def embed(self, texts, model_name, background=False):
+        with self.guards['embed'].slot(background):
+            return MODEL.embed(texts, model_name, timeout=MODEL_TIMEOUT)
+
+    def generate(self, prompt, system=None):
+        with self.guards['generate'].slot():
+            return MODEL.generate(prompt, timeout=MODEL_TIMEOUT, system=system)
+
+    def generate_stream(self, prompt, system=None):
+        # Giữ chỗ tới khi stream kết thúc (hoặc client ngắt kết nối)
+        with self.guards['generate'].slot():
+            yield from MODEL.generate_stream(prompt, timeout=MODEL_STREAM_TIMEOUT, system=system)
+
+MODEL_CLIENT = ModelClient()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
-app.config["SESSION_TYPE"] = "filesystem"
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('sqlite'):
+    # Worker gthread/gevent phục vụ nhiều request cùng lúc; request /chat trả kết nối về pool
+    # trước khi gọi mô hình (xem prepare_chat_turn), nên pool nhỏ vẫn đủ
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'pool_pre_ping': True,
+    }
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
-Session(app)
 # Cấu hình upload folder cho PDF
 UPLOAD_FOLDER = './static'
 ALLOWED_EXTENSIONS = {'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Giới hạn 16MB
 
+# ================== ĐO LƯỜNG (METRICS) ==================
+# Histogram/counter tối giản, xuất ở /metrics theo định dạng text của Prometheus (không cần thư viện).
+# Mỗi worker gunicorn đếm riêng; nhãn worker=<pid> để Prometheus cộng lại (sum by).
+# stage("tên") đo từng bước xử lý /chat; METRICS_SERVER_TIMING=1 gửi kèm header Server-Timing
+# (thời gian các bước của chính request đó) để debug trên tab Network của trình duyệt.
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', '0') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # nếu đặt: /metrics yêu cầu "Authorization: Bearer <token>"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_REGISTRY = []
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name, list(zip(self.labelnames, labels)), value) for labels, value in items]
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # nhãn -> [số mẫu theo từng bucket..., tổng, số mẫu]
+        self.lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(row)) for labels, row in self.values.items()]
+        result = []
+        for labels, row in items:
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                result.append((self.name + '_bucket', pairs + [('le', repr(float(bound)))], cumulative))
+            result.append((self.name + '_bucket', pairs + [('le', '+Inf')], row[-1]))
+            result.append((self.name + '_sum', pairs, row[-2]))
+            result.append((self.name + '_count', pairs, row[-1]))
+        return result
+
+class CallbackMetric:
+    # Giá trị đọc lúc scrape (kích thước cache, chỉ mục...): fn() -> [(nhãn dict, giá trị)]
+    def __init__(self, name, help_text, metric_type, fn):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.fn = fn
+        METRICS_REGISTRY.append(self)
+
+    def samples(self):
+        return [(self.name, list(labels.items()), value) for labels, value in self.fn()]
+
+def render_metrics():
+    worker = [('worker', os.getpid())]
+    lines = []
+    for metric in METRICS_REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            print(f"⚠️ Lỗi khi đọc metric {metric.name}: {e}")
+            continue
+        for name, pairs, value in samples:
+            value = value if isinstance(value, int) else repr(float(value))
+            lines.append(f'{name}{_format_labels(worker + pairs)} {value}')
+    return '\n'.join(lines) + '\n'
+
+STAGE_SECONDS = Histogram('app_stage_seconds', 'Thời gian từng bước xử lý (giây)', ('stage',))
+STAGE_ERRORS = Counter('app_stage_errors_total', 'Số lần một bước xử lý ném lỗi', ('stage',))
+HTTP_SECONDS = Histogram('app_http_request_seconds', 'Thời gian xử lý request tới khi gửi header (giây)', ('endpoint', 'status'))
+EMBED_BATCHES = Counter('app_embed_batches_total', 'Số lần gọi API nhúng theo lô', ('outcome',))
+EMBED_RETRIES = Counter('app_embed_retries_total', 'Số lần thử lại lô nhúng trong embed_with_retry')
+PROMPT_TOKENS = Histogram('app_prompt_tokens', 'Số token (ước lượng) của phần prompt thay đổi theo request',
+                          buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 8000))
+MODEL_CALLS = Counter('app_model_calls_total', 'Lời gọi mô hình theo loại và kết quả (ok/error/overload/throttled/circuit_open/cancelled)', ('kind', 'outcome'))
+SESSIONS_EXPIRED = Counter('app_sessions_expired_total', 'Số phiên hết hạn đã bị luồng dọn xóa', ('backend',))
+RETRIEVAL_REQUESTS = Counter('app_retrieval_total', 'Số lần truy xuất ngữ cảnh theo chế độ (vector/bm25/hybrid/bm25_fallback)', ('mode',))
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        if has_request_context():
+            g.setdefault('stage_timings', []).append((name, elapsed))
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    HTTP_SECONDS.observe(elapsed, request.endpoint or 'unknown', response.status_code)
+    if METRICS_SERVER_TIMING:
+        timings = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in g.get('stage_timings', [])]
+        timings.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(db.Model):
     __tablename__ = 'taikhoan_hocsinh'
     id = db.Column(db.Integer, primary_key=True)
@@ -50,104 +577,1754 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     name = db.Column(db.Text, default='')
     level = db.Column(db.String(20), default='Đạt yêu cầu')
-    history = db.Column(db.Text, default='')
-    lydo = db.Column(db.Text, default='')
+    lydo = db.deferred(db.Column(db.Text, default=''))  # chỉ tải khi cần (trang chi tiết)
+    __table_args__ = (
+        # Sắp xếp/phân trang trang admin theo tên hoặc năng lực (id để thứ tự ổn định)
+        db.Index('ix_taikhoan_hocsinh_name_id', 'name', 'id'),
+        db.Index('ix_taikhoan_hocsinh_level_id', 'level', 'id'),
+    )
+
+class Message(db.Model):
+    # Lịch sử hội thoại: mỗi tin nhắn một dòng, chỉ thêm mới (thay cho cột history cũ)
+    __tablename__ = 'tinnhan_hocsinh'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('taikhoan_hocsinh.id', ondelete='CASCADE'), nullable=False)
+    role = db.Column(db.String(10), nullable=False)  # student / teacher
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    text = db.Column(db.Text, nullable=False)
+    __table_args__ = (
+        db.Index('ix_tinnhan_hocsinh_user_role_id', 'user_id', 'role', 'id'),
+    )
+
+STUDENT_PREFIX = "👧 Học sinh: "
+TEACHER_PREFIX = "🧑‍🏫 Thầy/Cô: "
+HISTORY_PROMPT_MESSAGES = int(os.getenv('HISTORY_PROMPT_MESSAGES', 10))
+
+def recent_student_questions(user_id, limit=HISTORY_PROMPT_MESSAGES):
+    # N câu hỏi gần nhất (cũ -> mới), đọc bằng index (user_id, role, id)
+    rows = db.session.scalars(
+        db.select(Message.text)
+        .where(Message.user_id == user_id, Message.role == 'student')
+        .order_by(Message.id.desc())
+        .limit(limit)
+    ).all()
+    return [STUDENT_PREFIX + text for text in reversed(rows)]
+
+def count_student_questions(user_id):
+    return db.session.scalar(
+        db.select(db.func.count(Message.id)).where(Message.user_id == user_id, Message.role == 'student')
+    )
+
+class EvaluationJob(db.Model):
+    __tablename__ = 'danhgia_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('taikhoan_hocsinh.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending / running / done / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, default='')
+    owner = db.Column(db.String(100))  # "máy:pid" của tiến trình đang/đã chạy job
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    __table_args__ = (
+        # Mỗi học sinh chỉ có một job đang chờ/đang chạy
+        db.Index('ix_danhgia_jobs_active_user', 'user_id', unique=True,
+                 postgresql_where=text("status IN ('pending', 'running')"),
+                 sqlite_where=text("status IN ('pending', 'running')")),
+        db.Index('ix_danhgia_jobs_status', 'status'),
+    )
+
+# ================== PHIÊN ĐĂNG NHẬP ==================
+# Phiên phía server thay cho Flask-Session "filesystem". Cách cũ ghi mỗi người dùng một file
+# pickle trên đĩa cục bộ, không bao giờ xóa và không dùng chung được giữa các máy.
+# Cookie chỉ chứa session id ngẫu nhiên. Dữ liệu phiên (user_id, admin_session, flash) nằm ở:
+# - SESSION_BACKEND="sql" (mặc định): bảng phien_dang_nhap trong CSDL chính, dùng chung giữa
+#   các worker và các máy
+# - SESSION_BACKEND="memory": dict LRU trong tiến trình (tối đa SESSION_MAX_ENTRIES phiên), chỉ
+#   dùng cho dev/benchmark chạy một worker
+# Phiên hết hạn sau SESSION_TTL giây không hoạt động. Hạn chỉ được ghi lại khi đã trôi qua
+# quá nửa, không ghi ở mọi request. Luồng nền xóa phiên hết hạn mỗi SESSION_SWEEP_INTERVAL giây.
+# Dữ liệu mỗi phiên tối đa SESSION_MAX_BYTES; lịch sử hội thoại nằm ở bảng tinnhan_hocsinh.
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sql')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 7 * 24 * 3600))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 4096))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 10000))
+SESSION_ESSENTIAL_KEYS = ('user_id', 'admin_session')  # giữ lại khi phiên vượt SESSION_MAX_BYTES
+app.permanent_session_lifetime = timedelta(seconds=SESSION_TTL)
+
+class SessionRecord(db.Model):
+    __tablename__ = 'phien_dang_nhap'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_phien_dang_nhap_expires_at', 'expires_at'),
+    )
+
+class SqlSessionStore:
+    name = 'sql'
+
+    def get(self, sid):
+        # -> (dữ liệu, hạn) hoặc None nếu không có/đã hết hạn (luồng dọn sẽ xóa sau)
+        record = db.session.get(SessionRecord, sid)
+        if record is None or record.expires_at <= utcnow():
+            return None
+        return record.data, record.expires_at
+
+    def set(self, sid, data, expires_at):
+        db.session.merge(SessionRecord(id=sid, data=data, expires_at=expires_at))
+        db.session.commit()
+
+    def delete(self, sid):
+        db.session.execute(db.delete(SessionRecord).where(SessionRecord.id == sid))
+        db.session.commit()
+
+    def sweep(self, now):
+        result = db.session.execute(db.delete(SessionRecord).where(SessionRecord.expires_at <= now))
+        db.session.commit()
+        return result.rowcount
+
+class MemorySessionStore:
+    name = 'memory'
 
-with app.app_context():
-    # Đảm bảo schema public tồn tại
-    db.session.execute(text('CREATE SCHEMA IF NOT EXISTS public;'))
-    db.create_all()
-    print("✅ Đã kiểm tra/tạo bảng taikhoan_hocsinh trong schema public")
+    def __init__(self, max_entries):
+        self.entries = OrderedDict()  # sid -> (dữ liệu, hạn), cũ nhất ở đầu
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
 
-# Biến toàn cục cho RAG
+    def get(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None or entry[1] <= utcnow():
+                return None
+            self.entries.move_to_end(sid)
+            return entry
+
+    def set(self, sid, data, expires_at):
+        with self.lock:
+            self.entries[sid] = (data, expires_at)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def sweep(self, now):
+        with self.lock:
+            expired = [sid for sid, (_, expires_at) in self.entries.items() if expires_at <= now]
+            for sid in expired:
+                del self.entries[sid]
+        return len(expired)
+
+SESSION_STORES = {'sql': SqlSessionStore, 'memory': lambda: MemorySessionStore(SESSION_MAX_ENTRIES)}
+if SESSION_BACKEND not in SESSION_STORES:
+    raise ValueError(f"❌ SESSION_BACKEND không hợp lệ: {SESSION_BACKEND} (chọn {', '.join(SESSION_STORES)})")
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()  # JSON có gắn kiểu (tuple của flash...), không dùng pickle
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        # Request không có cookie (health check, trang đăng nhập lần đầu) không chạm tới store
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            try:
+                entry = self.store.get(sid)
+            except Exception as e:
+                db.session.rollback()  # ví dụ: bảng chưa được tạo khi init_db còn chạy nền
+                print(f"⚠️ Không đọc được phiên: {e}")
+                entry = None
+            if entry is not None:
+                data, expires_at = entry
+                return ServerSession(self.serializer.loads(data), sid=sid, expires_at=expires_at)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        try:
+            if not session:
+                if session.sid and session.modified:  # đăng xuất: xóa phiên và cookie
+                    self.store.delete(session.sid)
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+            now = utcnow()
+            lifetime = app.permanent_session_lifetime
+            if not session.modified and session.expires_at - now > lifetime / 2:
+                return
+            data = self.serializer.dumps(dict(session))
+            if len(data) > SESSION_MAX_BYTES:
+                print(f"⚠️ Phiên {len(data)} byte vượt SESSION_MAX_BYTES, chỉ giữ {', '.join(SESSION_ESSENTIAL_KEYS)}")
+                data = self.serializer.dumps({k: session[k] for k in SESSION_ESSENTIAL_KEYS if k in session})
+            sid = session.sid or secrets.token_urlsafe(32)
+            expires_at = now + lifetime
+            self.store.set(sid, data, expires_at)
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Lỗi khi lưu phiên: {e}")
+            return
+        _ensure_session_sweeper()
+        response.set_cookie(name, sid, expires=expires_at, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+SESSION_STORE = SESSION_STORES[SESSION_BACKEND]()
+app.session_interface = ServerSessionInterface(SESSION_STORE)
+_session_sweeper = {"pid": None, "thread": None}
+_session_sweeper_lock = threading.Lock()
+
+def sweep_sessions():
+    removed = SESSION_STORE.sweep(utcnow())
+    if removed:
+        SESSIONS_EXPIRED.inc(SESSION_STORE.name, amount=removed)
+        print(f"🧹 Đã xóa {removed} phiên hết hạn")
+    return removed
+
+def _session_sweeper_loop():
+    while True:
+        # Lệch thời điểm giữa các worker để không cùng xóa một lúc
+        time.sleep(SESSION_SWEEP_INTERVAL * (0.5 + random.random()))
+        with app.app_context():
+            try:
+                sweep_sessions()
+            except Exception as e:
+                db.session.rollback()
+                print(f"⚠️ Lỗi khi dọn phiên hết hạn: {e}")
+            finally:
+                db.session.remove()
+
+def _ensure_session_sweeper():
+    # Khởi động lười như luồng đánh giá (và khởi động lại sau khi gunicorn fork)
+    if _session_sweeper["pid"] == os.getpid() and _session_sweeper["thread"].is_alive():
+        return
+    with _session_sweeper_lock:
+        if _session_sweeper["pid"] == os.getpid() and _session_sweeper["thread"].is_alive():
+            return
+        _session_sweeper["pid"] = os.getpid()
+        _session_sweeper["thread"] = threading.Thread(target=_session_sweeper_loop, name="session-sweeper", daemon=True)
+        _session_sweeper["thread"].start()
+
+# Các bước schema dưới đây chỉ do một process chạy tại một thời điểm: khi nhiều worker cùng khởi
+# động, worker thua cuộc đua tạo bảng/index sẽ gặp lỗi "already exists" hoặc deadlock.
+# PostgreSQL: advisory lock (đúng cả khi worker nằm trên nhiều máy); CSDL khác: khóa file.
+SCHEMA_LOCK_KEY = 0x74757472   # số bất kỳ, chỉ cần không trùng advisory lock khác trên cùng CSDL
+SCHEMA_LOCK_PATH = os.getenv('SCHEMA_LOCK_PATH', './rag_cache/schema.lock')
+LOCK_POLL = 0.1  # giây giữa các lần thử lấy khóa
+
+@contextmanager
+def exclusive_file_lock(path):
+    # Khóa giữa các process (flock); trên hệ không có fcntl thì không khóa gì.
+    # Không gọi flock chặn: gevent không vá fcntl, một worker gevent chờ khóa sẽ đứng cả event
+    # loop (không phục vụ, không heartbeat, bị gunicorn giết). Thử không chặn và ngủ giữa các lần.
+    with open(path, 'a') as f:
+        if fcntl:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(LOCK_POLL)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextmanager
+def schema_lock():
+    # Gọi trong app context
+    if db.engine.dialect.name != 'postgresql':
+        os.makedirs(os.path.dirname(SCHEMA_LOCK_PATH) or '.', exist_ok=True)
+        with exclusive_file_lock(SCHEMA_LOCK_PATH):
+            yield
+        return
+    with db.engine.connect() as conn:
+        while not conn.scalar(text('SELECT pg_try_advisory_lock(:key)'), {'key': SCHEMA_LOCK_KEY}):
+            conn.rollback()
+            time.sleep(LOCK_POLL)
+        try:
+            yield
+        finally:
+            try:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': SCHEMA_LOCK_KEY})
+                conn.commit()
+            except Exception:
+                conn.invalidate()  # đóng hẳn kết nối để khóa không bị giữ lại trong pool
+
+# Index GIN trigram cho ô tìm kiếm trang admin (ILIKE '%q%' trên PostgreSQL), giống migration
+# 8d1c2b7e5a90. CSDL mới: migration chạy khi chưa có bảng nên không tạo, init_db tạo ở đây.
+ADMIN_TRGM_INDEXES = {
+    'ix_taikhoan_hocsinh_username_trgm': 'username',
+    'ix_taikhoan_hocsinh_name_trgm': 'name',
+}
+
+def ensure_admin_search_indexes():
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for name, column in ADMIN_TRGM_INDEXES.items():
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON taikhoan_hocsinh USING gin ({column} gin_trgm_ops)'))
+    except DBAPIError as e:
+        # Tài khoản CSDL không được tạo extension: tìm kiếm vẫn chạy nhưng quét tuần tự
+        print(f"⚠️ Không tạo được index tìm kiếm pg_trgm: {e}")
+
+def init_db():
+    # Chạy nền khi khởi động (xem start_warmup) hoặc bằng lệnh: flask --app app init-db
+    # Chỉ tạo bảng/index còn thiếu. Thay đổi bảng đã có dữ liệu (vd. bỏ cột history cũ) nằm trong
+    # migrations/ và chạy một lần khi deploy: STARTUP_WARMUP=0 flask --app app db upgrade (Procfile: release)
+    with app.app_context(), schema_lock():
+        # Đảm bảo schema public tồn tại (chỉ PostgreSQL có khái niệm schema)
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text('CREATE SCHEMA IF NOT EXISTS public;'))
+        db.create_all()
+        # create_all không thêm index mới vào bảng đã có sẵn
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        if db.engine.dialect.name == 'postgresql':
+            ensure_admin_search_indexes()
+        print("✅ Đã kiểm tra/tạo bảng taikhoan_hocsinh trong schema public")
+
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions_command():
+    # Cho cron/scheduler, khi không muốn dựa vào luồng dọn trong worker
+    sweep_sessions()
+
+# Biến toàn cục cho RAG: mỗi lần cập nhật tạo một snapshot mới rồi gán lại RAG_DATA
+# (thao tác gán là nguyên tử), nên /chat không bao giờ thấy chỉ mục dựng dở.
+# source_names[source_ids[i]] cho biết dòng i (chunk + vector) thuộc file PDF nào,
+# chunk_meta[i] = (trang, start, end) là vị trí của chunk đó trong văn bản của file;
+# "name" là thư mục thế hệ trên đĩa mà snapshot được nạp từ đó.
 RAG_DATA = {
     "chunks": [],
     "embeddings": np.array([]),
+    "index": None,
+    "bm25": None,
+    "source_ids": np.array([], dtype=np.int32),
+    "chunk_meta": np.zeros((0, 3), dtype=np.int64),
+    "source_names": [],
+    "files": [],
+    "name": None,
+    "generation": 0,
     "is_ready": False
 }
+# Chỉ một luồng được cập nhật chỉ mục RAG tại một thời điểm
+RAG_WRITE_LOCK = threading.Lock()
 
 # ================== ĐỌC & CHIA CHUNKS ==================
-def extract_pdf_text(pdf_path):
-    text = ""
+# Trích xuất theo từng khoảng PDF_PAGES_PER_JOB trang trên một process pool (PDF_WORKERS
+# tiến trình), kết quả được tiêu thụ theo đúng thứ tự file/trang và chia chunk ngay khi
+# có trang mới, nên không bao giờ giữ toàn bộ văn bản của corpus trong bộ nhớ.
+# Văn bản đã trích xuất được cache theo (đường dẫn, kích thước, mtime) trong
+# PDF_TEXT_CACHE_DIR: file PDF không đổi sẽ không bao giờ phải đọc lại.
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_JOB = int(os.getenv('PDF_PAGES_PER_JOB', 8))
+PDF_TEXT_CACHE_DIR = os.getenv('PDF_TEXT_CACHE_DIR', './rag_cache/text')
+
+def _pdf_pool_context():
+    # Không dùng "fork": process này luôn có nhiều luồng (warmup, gthread, upload, đánh giá), fork lúc
+    # một luồng khác đang giữ khóa (logging, pool SQLAlchemy, limiter) có thể làm tiến trình con treo.
+    # forkserver: tiến trình con được fork từ một server sạch chỉ nạp sẵn pdf_extract và PyPDF2.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['pdf_extract', 'PyPDF2'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+def count_pdf_pages(pdf_path):
+    import PyPDF2
     try:
         with open(pdf_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
+            return len(PyPDF2.PdfReader(f).pages)
     except Exception as e:
         print(f"⚠️ Lỗi khi đọc PDF {pdf_path}: {e}")
-    return text
+        return 0
+
+def extract_pdf_text(pdf_path):
+    return "".join(extract_page_range(pdf_path, 0, count_pdf_pages(pdf_path))[0])
+
+def _pdf_text_cache(pdf_path):
+    # -> (đường dẫn file cache, header mô tả phiên bản PDF hiện tại)
+    abs_path = os.path.abspath(pdf_path)
+    st = os.stat(abs_path)
+    name = hashlib.sha256(abs_path.encode('utf-8')).hexdigest() + '.jsonl'
+    header = {"path": abs_path, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return os.path.join(PDF_TEXT_CACHE_DIR, name), header
+
+def _iter_cached_pages(cache_path):
+    with open(cache_path, encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+def _cache_is_valid(cache_path, header):
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.loads(f.readline() or 'null') == header
+    except (OSError, ValueError):
+        return False
+
+def _map_page_ranges(jobs):
+    # Chạy các job (pdf_path, start, stop) song song, trả kết quả theo đúng thứ tự,
+    # giữ tối đa 2 * PDF_WORKERS job đang chờ để bộ nhớ không tăng theo corpus
+    # Trong worker gevent không dùng process pool (luồng quản lý và hàng đợi của pool không hợp
+    # với các module đã bị vá): đọc tuần tự, nhường event loop sau mỗi job
+    if PDF_WORKERS <= 1 or len(jobs) <= 1 or gevent_patched():
+        for job in jobs:
+            yield extract_page_range(*job)
+            cooperative_yield()
+        return
+    with ProcessPoolExecutor(max_workers=min(PDF_WORKERS, len(jobs)), mp_context=_pdf_pool_context()) as pool:
+        job_iter = iter(jobs)
+        pending = deque(pool.submit(extract_page_range, *job)
+                        for job in itertools.islice(job_iter, 2 * PDF_WORKERS))
+        while pending:
+            result = pending.popleft().result()
+            job = next(job_iter, None)
+            if job is not None:
+                pending.append(pool.submit(extract_page_range, *job))
+            yield result
+
+def iter_pdf_pages(directory, filenames):
+    # Sinh (filename, văn bản một trang) theo đúng thứ tự file và trang
+    plan = []
+    for filename in filenames:
+        pdf_path = os.path.join(directory, filename)
+        cache_path, header = _pdf_text_cache(pdf_path)
+        if _cache_is_valid(cache_path, header):
+            plan.append((filename, cache_path, header, None))
+        else:
+            n_pages = count_pdf_pages(pdf_path)
+            ranges = [(pdf_path, i, i + PDF_PAGES_PER_JOB) for i in range(0, n_pages, PDF_PAGES_PER_JOB)]
+            plan.append((filename, cache_path, header, ranges))
+
+    results = _map_page_ranges([job for *_, ranges in plan if ranges for job in ranges])
+    for filename, cache_path, header, ranges in plan:
+        if ranges is None:
+            for page in _iter_cached_pages(cache_path):
+                yield filename, page
+            continue
+        os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        complete = True
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(json.dumps(header) + '\n')
+            for _ in ranges:
+                pages, ok = next(results)
+                complete = complete and ok
+                for page in pages:
+                    cache_file.write(json.dumps(page, ensure_ascii=False) + '\n')
+                    yield filename, page
+        # Chỉ cache khi đọc được toàn bộ file, để lần sau còn thử lại
+        if complete:
+            os.replace(tmp_path, cache_path)
+        else:
+            os.remove(tmp_path)
+
+# Chia theo cấu trúc: không chunk nào vượt qua ranh giới trang. Trong một trang, văn bản được
+# tách thành các mục tại dòng mở đầu bài tập/tiêu đề (CHUNK_HEADING_RE), rồi gom nguyên mục vào
+# chunk tới RAG_CHUNK_SIZE ký tự. Mục dài hơn thì cắt ở cuối dòng/câu, chunk sau lặp lại tối đa
+# RAG_CHUNK_OVERLAP ký tự cuối của chunk trước (cũng bắt đầu ở đầu dòng/câu).
+# Mỗi chunk kèm (trang, start, end): vị trí ký tự trong văn bản của file (các trang nối bằng
+# "\n"), nên chunk == văn bản[start:end] và truy xuất có thể nối các chunk kề nhau.
+RAG_CHUNK_SIZE = int(os.getenv('RAG_CHUNK_SIZE', 800))
+RAG_CHUNK_OVERLAP = int(os.getenv('RAG_CHUNK_OVERLAP', 100))
+CHUNK_HEADING_RE = re.compile(
+    r'^[ \t]*(?:Chương|Bài|Luyện tập|Vận dụng|Thực hành|Hoạt động|Thử thách|Ví dụ|Lời giải|Hướng dẫn giải'
+    r'|Định nghĩa|Định lí|Định lý|Tính chất|Chú ý|Nhận xét|Câu \d)', re.MULTILINE)
+_CHUNK_BREAK_RE = re.compile(r'\n\s*|(?<=[.!?;])\s+')
+
+def _trim_span(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def _last_break(text, lo, hi):
+    # Vị trí cuối dòng/câu muộn nhất trong (lo, hi], không có thì khoảng trắng, không có nữa thì hi
+    cut = None
+    for m in _CHUNK_BREAK_RE.finditer(text, lo, hi):
+        cut = m.end()
+    if cut is None:
+        space = text.rfind(' ', lo, hi)
+        cut = space + 1 if space > lo else hi
+    return cut
+
+def _first_break(text, lo, hi):
+    # Đầu dòng/câu sớm nhất trong [lo, hi), không có thì hi (bỏ phần chồng lấn)
+    m = _CHUNK_BREAK_RE.search(text, lo, hi)
+    return m.end() if m else hi
 
-def create_chunks_from_directory(directory='./static', chunk_size=400):
+def _split_section(text, start, end, chunk_size, overlap):
+    while end - start > chunk_size:
+        cut = _last_break(text, start + chunk_size // 2, start + chunk_size)
+        if not text[cut:end].strip():
+            break  # phần còn lại chỉ là khoảng trắng: không tạo chunk chỉ gồm phần chồng lấn
+        yield start, cut
+        next_start = _first_break(text, cut - overlap, cut) if overlap > 0 else cut
+        start = next_start if next_start > start else cut
+    yield start, end
+
+def split_page(text, chunk_size=RAG_CHUNK_SIZE, overlap=RAG_CHUNK_OVERLAP):
+    # -> các khoảng (start, end) của chunk trong một trang, đã bỏ khoảng trắng hai đầu
+    bounds = sorted({0, len(text), *(m.start() for m in CHUNK_HEADING_RE.finditer(text))})
+    spans = []
+    current = None  # (start, end) của chunk đang gom
+    for start, end in zip(bounds, bounds[1:]):
+        if current and end - current[0] <= chunk_size:
+            current = (current[0], end)
+            continue
+        if current:
+            spans.append(current)
+        if end - start <= chunk_size:
+            current = (start, end)
+        else:
+            *pieces, current = _split_section(text, start, end, chunk_size, overlap)
+            spans.extend(pieces)
+    if current:
+        spans.append(current)
+    spans = [_trim_span(text, start, end) for start, end in spans]
+    return [(start, end) for start, end in spans if end > start]
+
+def iter_chunks_from_pages(pages, chunk_size=RAG_CHUNK_SIZE, overlap=RAG_CHUNK_OVERLAP):
+    # -> (chunk, (số trang bắt đầu từ 1, start, end)); start/end tính trong văn bản cả file
+    offset = 0
+    for page_no, page in enumerate(pages, 1):
+        for start, end in split_page(page, chunk_size, overlap):
+            yield page[start:end], (page_no, offset + start, offset + end)
+        offset += len(page) + 1
+        cooperative_yield()
+
+def iter_chunks_from_directory(directory, filenames, chunk_size=RAG_CHUNK_SIZE, overlap=RAG_CHUNK_OVERLAP):
+    # Sinh (filename, chunk, meta) cho các file PDF, trang nào đọc xong thì chia chunk ngay.
+    # Tên file không còn chèn vào chunk: nguồn nằm trong source_ids/chunk_meta, được ghi kèm
+    # khi đưa vào prompt (xem merge_hits), nên vector và BM25 chỉ phản ánh nội dung.
+    for filename, pages in itertools.groupby(iter_pdf_pages(directory, filenames), key=lambda item: item[0]):
+        for chunk, meta in iter_chunks_from_pages((page for _, page in pages), chunk_size, overlap):
+            yield filename, chunk, meta
+
+def create_chunks_from_pdf(directory, filename):
+    # -> (chunks, meta)
+    chunks, meta = [], []
+    for _, chunk, chunk_meta in iter_chunks_from_directory(directory, [filename]):
+        chunks.append(chunk)
+        meta.append(chunk_meta)
+    return chunks, meta
+
+def create_chunks_from_directory(directory='./static'):
+    # -> (chunks, tên file của từng chunk, (trang, start, end) của từng chunk)
     all_chunks = []
+    all_sources = []
+    all_meta = []
     if not os.path.exists(directory):
         print(f"Thư mục {directory} không tồn tại.")
-        return []
+        return [], [], []
     pdf_files = [f for f in os.listdir(directory) if f.endswith('.pdf')]
     print(f"🔍 Tìm thấy {len(pdf_files)} tệp PDF trong {directory}...")
-    for filename in pdf_files:
-        pdf_path = os.path.join(directory, filename)
-        content = extract_pdf_text(pdf_path)
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i + chunk_size].strip()
-            if chunk:
-                all_chunks.append(f"[Nguồn: {filename}] {chunk}")
+    for filename, chunk, meta in iter_chunks_from_directory(directory, pdf_files):
+        all_chunks.append(chunk)
+        all_sources.append(filename)
+        all_meta.append(meta)
     print(f"✅ Đã tạo tổng cộng {len(all_chunks)} đoạn văn (chunks).")
-    return all_chunks
+    return all_chunks, all_sources, all_meta
 
-def embed_with_retry(texts, model_name, max_retries=5):
-    all_embeddings = []
-    for text in texts:
-        for attempt in range(max_retries):
-            try:
-                result = genai.embed_content(model=model_name, content=text)
-                all_embeddings.append(result["embedding"])
-                break
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"⚠️ Thử lại lần {attempt+1}: {e}")
-                    time.sleep(2 ** attempt)
-                else:
-                    print(f"💥 Thất bại sau {max_retries} lần: {e}")
-                    raise
-    return np.array(all_embeddings)
+# Nhúng theo lô: mỗi request gửi tối đa EMBED_BATCH_SIZE đoạn văn, chạy song song
+# trên EMBED_MAX_WORKERS luồng, giới hạn EMBED_RATE_LIMIT request/giây (token bucket).
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', 100))
+EMBED_MAX_WORKERS = int(os.getenv('EMBED_MAX_WORKERS', 4))
+EMBED_RATE_LIMIT = float(os.getenv('EMBED_RATE_LIMIT', 10))
+EMBED_RATE_BURST = int(os.getenv('EMBED_RATE_BURST', EMBED_MAX_WORKERS))
 
-def initialize_rag_data():
-    global RAG_DATA
-    print("⏳ Đang khởi tạo dữ liệu RAG...")
-    chunks = create_chunks_from_directory()
-    if not chunks:
-        print("Không có dữ liệu để nhúng.")
-        return
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+EMBED_RATE_LIMITER = TokenBucket(EMBED_RATE_LIMIT, EMBED_RATE_BURST)
+
+def _embed_batch(batch, model_name, background=False):
+    return MODEL_CLIENT.embed(batch, model_name, background=background)
+
+def _embed_batch_with_retry(batch, model_name, max_retries):
+    for attempt in range(max_retries):
+        EMBED_RATE_LIMITER.acquire()
+        try:
+            vectors = _embed_batch(batch, model_name, background=True)
+            if len(vectors) != len(batch):
+                raise ValueError(f"API trả về {len(vectors)} vector cho {len(batch)} đoạn văn")
+            EMBED_BATCHES.inc('ok')
+            return vectors
+        except Exception as e:
+            EMBED_BATCHES.inc('error')
+            if attempt < max_retries - 1:
+                EMBED_RETRIES.inc()
+                print(f"⚠️ Thử lại lô {len(batch)} đoạn lần {attempt+1}: {e}")
+                # Backoff có jitter để các luồng không thử lại cùng lúc
+                time.sleep(2 ** attempt * (0.5 + random.random() / 2))
+            else:
+                print(f"💥 Thất bại sau {max_retries} lần: {e}")
+                raise
+
+def embed_once(texts, model_name):
+    # Cho đường request (nhúng câu hỏi): mỗi lô chỉ gọi một lần, không qua token bucket và
+    # không backoff. Lỗi được ném ngay cho người gọi (search_rag sẽ chuyển sang BM25).
+    vectors = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[i:i + EMBED_BATCH_SIZE]
+        result = _embed_batch(batch, model_name)
+        if len(result) != len(batch):
+            raise ValueError(f"API trả về {len(result)} vector cho {len(batch)} đoạn văn")
+        vectors.extend(result)
+    return np.array(vectors)
+
+def embed_with_retry(texts, model_name, max_retries=5, batch_size=None, max_workers=None):
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    max_workers = max_workers or EMBED_MAX_WORKERS
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if len(batches) <= 1 or max_workers <= 1:
+        results = [_embed_batch_with_retry(b, model_name, max_retries) for b in batches]
+    else:
+        # pool.map giữ đúng thứ tự các lô, nên vector đầu ra khớp thứ tự texts
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as pool:
+            results = list(pool.map(lambda b: _embed_batch_with_retry(b, model_name, max_retries), batches))
+    return np.array([vec for vectors in results for vec in vectors])
+
+# ================== CACHE EMBEDDING TRÊN ĐĨA ==================
+# Mỗi bản ghi: sha256(EMBEDDING_MODEL + chunk) (32 byte) + vector float32.
+# Header: magic, phiên bản định dạng, số chiều vector.
+# File được mmap và chỉ mở khi cần nhúng (embed_with_cache), không phải lúc import: worker dùng
+# lại chỉ mục có sẵn không tốn gì, còn khi cần thì vector nằm trong page cache dùng chung cho
+# mọi worker; mỗi process chỉ giữ dict khóa -> số thứ tự bản ghi.
+EMBED_CACHE_PATH = os.getenv('EMBED_CACHE_PATH', './rag_cache/embeddings.bin')
+EMBED_CACHE_MAGIC = b'RAGEMB'
+EMBED_CACHE_VERSION = 1
+_EMBED_CACHE_HEADER = struct.Struct('<6sHI')
+
+class EmbeddingCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dim = None
+        self.index = {}       # khóa -> số thứ tự bản ghi trong file
+        self.records = None   # mảng bản ghi mmap (chỉ phần đã đọc tới)
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, model_name):
+        return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).digest()
+
+    def _record_dtype(self):
+        # 'V32' thay vì 'S32': giữ nguyên byte 0 ở cuối khóa khi đọc ra
+        return np.dtype([('key', 'V32'), ('vec', '<f4', (self.dim,))])
+
+    def _reset(self, dim):
+        self.dim = dim
+        self.index = {}
+        self.records = None
+
+    def _rows(self):
+        return 0 if self.records is None else len(self.records)
+
+    def _load(self):
+        # Map phần file mà process này chưa thấy: worker khác có thể đã ghi thêm bản ghi
+        # (hoặc tạo file) sau lần đọc trước. Rẻ khi file không đổi (một lần đọc header).
+        first = not self.loaded
+        self.loaded = True
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(_EMBED_CACHE_HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            self._reset(None)
+            return
+        except OSError as e:
+            print(f"⚠️ Lỗi khi đọc cache embedding {self.path}: {e}")
+            self._reset(None)
+            return
+        if len(header) < _EMBED_CACHE_HEADER.size:
+            self._reset(None)
+            return
+        magic, version, dim = _EMBED_CACHE_HEADER.unpack(header)
+        if magic != EMBED_CACHE_MAGIC or version != EMBED_CACHE_VERSION or dim == 0:
+            if first:
+                print(f"⚠️ Cache embedding {self.path} không đúng định dạng/phiên bản, bỏ qua.")
+            self._reset(None)
+            return
+        if dim != self.dim:
+            self._reset(dim)
+        # Bỏ qua bản ghi cuối bị ghi dở (nếu tiến trình bị dừng giữa chừng)
+        rows = (size - _EMBED_CACHE_HEADER.size) // self._record_dtype().itemsize
+        old_rows = self._rows()
+        if rows > old_rows:
+            self.records = np.memmap(self.path, dtype=self._record_dtype(), mode='r',
+                                     offset=_EMBED_CACHE_HEADER.size, shape=(rows,))
+            for row, key in enumerate(self.records['key'][old_rows:].tolist(), old_rows):
+                self.index.setdefault(key, row)
+        if first:
+            print(f"📦 Đã mở cache embedding {self.path} ({len(self.index)} embedding)")
+
+    def get_many(self, keys):
+        with self.lock:
+            self._load()
+            found = [np.array(self.records['vec'][self.index[k]]) if k in self.index else None for k in keys]
+            hits = sum(1 for v in found if v is not None)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, keys, vectors):
+        # Gọi khi đang giữ rag_build_lock(): chỉ một process ghi file tại một thời điểm
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.size == 0:
+            return
+        with self.lock:
+            self._load()
+            dim = vectors.shape[1]
+            if self.dim != dim:
+                # Chưa có file hợp lệ, hoặc header trên đĩa đúng là số chiều khác (đổi model):
+                # tạo lại file cache với header mới
+                self._reset(dim)
+                self._write(truncate=True, records=None)
+            seen = set()
+            new = []
+            for i, k in enumerate(keys):
+                if k not in self.index and k not in seen:
+                    seen.add(k)
+                    new.append(i)
+            if new:
+                records = np.empty(len(new), dtype=self._record_dtype())
+                records['key'] = [keys[i] for i in new]
+                records['vec'] = vectors[new]
+                self._write(truncate=False, records=records)
+                self._load()
+
+    def _write(self, truncate, records):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            if truncate or not os.path.exists(self.path):
+                with open(self.path, 'wb') as f:
+                    f.write(_EMBED_CACHE_HEADER.pack(EMBED_CACHE_MAGIC, EMBED_CACHE_VERSION, self.dim))
+            if records is not None:
+                with open(self.path, 'ab') as f:
+                    # Bỏ bản ghi ghi dở ở cuối file để bản ghi mới thẳng hàng
+                    f.truncate(_EMBED_CACHE_HEADER.size + self._rows() * records.itemsize)
+                    f.write(records.tobytes())
+        except Exception as e:
+            print(f"⚠️ Không ghi được cache embedding {self.path}: {e}")
+
+EMBED_CACHE = EmbeddingCache(EMBED_CACHE_PATH)
+
+def embed_with_cache(texts, model_name):
+    keys = [EmbeddingCache.make_key(t, model_name) for t in texts]
+    found = EMBED_CACHE.get_many(keys)
+    missing = [i for i, v in enumerate(found) if v is None]
+    print(f"📦 Cache embedding: {len(texts) - len(missing)} trúng, {len(missing)} trượt")
+    if missing:
+        new_vecs = np.asarray(embed_with_retry([texts[i] for i in missing], model_name), dtype=np.float32)
+        EMBED_CACHE.put_many([keys[i] for i in missing], new_vecs)
+        for i, vec in zip(missing, new_vecs):
+            found[i] = vec
+    return np.vstack(found).astype(np.float32, copy=False)
+
+# ================== CACHE CÂU HỎI & CÂU TRẢ LỜI ==================
+# - QUERY_EMBED_CACHE: LRU + TTL cho embedding của câu hỏi, khóa theo câu hỏi đã chuẩn hóa.
+# - ANSWER_CACHE: cache ngữ nghĩa cho câu trả lời, khớp khi cùng các chunk được truy xuất,
+#   cùng năng lực học sinh và vector câu hỏi đủ gần (>= ANSWER_CACHE_THRESHOLD).
+#   Bị xóa mỗi khi corpus RAG thay đổi (xem publish_rag_data).
+# - Các câu hỏi giống hệt nhau đến cùng lúc chỉ gọi API một lần (SingleFlight).
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 2048))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 3600))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 512))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 1800))
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_query(text):
+    text = unicodedata.normalize('NFC', text).casefold()
+    return _WHITESPACE_RE.sub(' ', text).strip(' ?!.')
+
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+class SemanticAnswerCache:
+    def __init__(self, max_size, ttl, threshold):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # (bucket, câu hỏi chuẩn hóa) -> (vector, câu trả lời, hạn)
+        self.buckets = {}             # (thế hệ corpus, chunk_ids, level) -> tập khóa entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query_vec, bucket):
+        now = time.monotonic()
+        best_key, best_sim = None, self.threshold
+        with self.lock:
+            for key in list(self.buckets.get(bucket, ())):
+                vec, answer, expires = self.entries[key]
+                if expires <= now:
+                    self._remove(key)
+                    continue
+                sim = float(vec @ query_vec)
+                if sim >= best_sim:
+                    best_key, best_sim = key, sim
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            return self.entries[best_key][1]
+
+    def set(self, query_vec, bucket, normalized_query, answer):
+        key = (bucket, normalized_query)
+        with self.lock:
+            self.entries[key] = (query_vec, answer, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            self.buckets.setdefault(bucket, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        del self.entries[key]
+        bucket_keys = self.buckets.get(key[0])
+        if bucket_keys is not None:
+            bucket_keys.discard(key)
+            if not bucket_keys:
+                del self.buckets[key[0]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+
+class SingleFlight:
+    # Gom các lời gọi cùng khóa đang chạy đồng thời về một lời gọi duy nhất
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+
+    def stream(self, key, fn, timeout=None):
+        # Như do() cho lời gọi trả về từng mảnh (fn() là iterator). Một luồng nền đọc fn() tới
+        # hết, kể cả khi client đầu tiên ngắt kết nối; mọi request cùng khóa (cả request đầu)
+        # nhận đủ các mảnh từ đầu ngay khi có. timeout: số giây tối đa chờ một mảnh mới.
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = {"cond": threading.Condition(), "pieces": [], "done": False, "error": None}
+                self.calls[key] = call
+                threading.Thread(target=self._pump, args=(key, call, fn), daemon=True).start()
+        return self._replay(call, timeout)
+
+    def _pump(self, key, call, fn):
+        try:
+            for piece in fn():
+                with call["cond"]:
+                    call["pieces"].append(piece)
+                    call["cond"].notify_all()
+        except Exception as e:
+            call["error"] = e
+        finally:
+            with self.lock:
+                del self.calls[key]
+            with call["cond"]:
+                call["done"] = True
+                call["cond"].notify_all()
+
+    @staticmethod
+    def _replay(call, timeout):
+        sent = 0
+        while True:
+            with call["cond"]:
+                if sent == len(call["pieces"]) and not call["done"]:
+                    if not call["cond"].wait_for(lambda: sent < len(call["pieces"]) or call["done"], timeout):
+                        raise TimeoutError(f"Không nhận được mảnh mới sau {timeout}s")
+                pieces = call["pieces"][sent:]
+                done = call["done"]
+            for piece in pieces:  # gửi ngoài khóa: client chậm không giữ chân luồng nền
+                yield piece
+            sent += len(pieces)
+            if done and sent == len(call["pieces"]):
+                if call["error"] is not None:
+                    raise call["error"]
+                return
+
+QUERY_EMBED_CACHE = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+ANSWER_CACHE = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD)
+QUERY_EMBED_FLIGHTS = SingleFlight()
+ANSWER_FLIGHTS = SingleFlight()
+ANSWER_STREAM_FLIGHTS = SingleFlight()  # /chat/stream: cùng khóa với ANSWER_FLIGHTS nhưng lời gọi dạng stream
+
+def embed_queries(queries):
+    # Embedding của câu hỏi: lấy từ cache, chỉ nhúng (một lượt) các câu chưa có
+    keys = [normalize_query(q) for q in queries]
+    vectors = [QUERY_EMBED_CACHE.get(k) for k in keys]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if len(missing) == 1:
+        i = missing[0]
+        def _embed_one():
+            with stage('embed_query'):
+                vec = normalize_rows(embed_once([queries[i]], EMBEDDING_MODEL))[0]
+            QUERY_EMBED_CACHE.set(keys[i], vec)
+            return vec
+        vectors[i] = QUERY_EMBED_FLIGHTS.do(keys[i], _embed_one)
+    elif missing:
+        with stage('embed_query'):
+            new_vecs = normalize_rows(embed_once([queries[i] for i in missing], EMBEDDING_MODEL))
+        for i, vec in zip(missing, new_vecs):
+            QUERY_EMBED_CACHE.set(keys[i], vec)
+            vectors[i] = vec
+    return np.vstack(vectors)
+
+# ================== TÌM KIẾM VECTOR ==================
+# Vector được chuẩn hóa sẵn (float32, độ dài 1) khi dựng chỉ mục, nên cosine similarity
+# chỉ còn là một phép nhân ma trận–vector; top-k chọn bằng argpartition thay vì argsort.
+# RAG_ANN: "auto" (IVF khi có từ RAG_ANN_MIN_ROWS dòng), "ivf" (luôn dùng) hoặc "exact".
+RAG_ANN = os.getenv('RAG_ANN', 'auto')
+RAG_ANN_MIN_ROWS = int(os.getenv('RAG_ANN_MIN_ROWS', 100000))
+RAG_ANN_NPROBE = int(os.getenv('RAG_ANN_NPROBE', 16))
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return np.zeros((0, matrix.shape[-1] if matrix.ndim == 2 else 0), dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def top_k_rows(scores, top_k):
+    # scores: (số câu hỏi, số dòng) -> chỉ số và điểm top-k của từng hàng, giảm dần
+    n = scores.shape[1]
+    k = min(top_k, n)
+    if k <= 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    if k < n:
+        idx = np.argpartition(scores, n - k, axis=1)[:, n - k:]
+    else:
+        idx = np.broadcast_to(np.arange(n), scores.shape)
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+class VectorIndex:
+    kind = 'exact'
+
+    def __init__(self, vectors, normalized=False):
+        self.vectors = np.asarray(vectors, dtype=np.float32) if normalized else normalize_rows(vectors)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def search_batch(self, queries, top_k=3):
+        # Trả về (danh sách chỉ số, danh sách điểm) cho từng câu hỏi, chấm điểm trong một lần nhân ma trận
+        queries = normalize_rows(queries)
+        if not len(self):
+            return top_k_rows(np.zeros((len(queries), 0), dtype=np.float32), top_k)
+        return top_k_rows(queries @ self.vectors.T, top_k)
+
+    def search(self, query, top_k=3):
+        idxs, scores = self.search_batch(query, top_k)
+        return idxs[0], scores[0]
+
+    def append(self, new_vectors):
+        new_vectors = normalize_rows(new_vectors)
+        if not len(self):
+            return build_vector_index(new_vectors, normalized=True)
+        return build_vector_index(np.concatenate([self.vectors, new_vectors]), normalized=True)
+
+    def select(self, rows):
+        return build_vector_index(self.vectors[rows], normalized=True)
+
+    def arrays(self):
+        # Các mảng được ghi xuống đĩa (nạp lại bằng mmap) và tham số đi kèm
+        return {'vectors': self.vectors}, {}
+
+    @classmethod
+    def from_arrays(cls, arrays, params):
+        index = cls.__new__(cls)
+        index.vectors = arrays['vectors']
+        return index
+
+def _assign_to_centroids(vectors, centroids, block=65536):
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block):
+        assign[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+    return assign
+
+def _train_centroids(vectors, nlist, iters=10, seed=0):
+    # Spherical k-means trên một mẫu ngẫu nhiên của corpus
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * 32)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+class IVFIndex(VectorIndex):
+    # Chỉ mục xấp xỉ (inverted file): mỗi câu hỏi chỉ quét nprobe cụm gần nhất
+    kind = 'ivf'
+
+    def __init__(self, vectors, normalized=False, nlist=None, nprobe=None, centroids=None, trained_rows=None):
+        super().__init__(vectors, normalized)
+        if centroids is None:
+            nlist = min(len(self), nlist or max(1, int(np.sqrt(len(self)))))
+            centroids = _train_centroids(self.vectors, nlist)
+            trained_rows = len(self)
+        self.centroids = centroids
+        self.trained_rows = trained_rows or len(self)
+        self.nprobe = min(nprobe or RAG_ANN_NPROBE, len(centroids))
+        assign = _assign_to_centroids(self.vectors, centroids)
+        self.order = np.argsort(assign, kind='stable')
+        self.offsets = np.searchsorted(assign[self.order], np.arange(len(centroids) + 1))
+
+    def search_batch(self, queries, top_k=3):
+        queries = normalize_rows(queries)
+        probes, _ = top_k_rows(queries @ self.centroids.T, self.nprobe)
+        all_idxs, all_scores = [], []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+            idxs, scores = top_k_rows((self.vectors[candidates] @ query).reshape(1, -1), top_k)
+            all_idxs.append(candidates[idxs[0]])
+            all_scores.append(scores[0])
+        return all_idxs, all_scores
+
+    def _derive(self, vectors):
+        # Giữ nguyên các tâm cụm khi thêm/xóa ít dòng; huấn luyện lại khi corpus tăng gấp đôi
+        if (RAG_ANN == 'auto' and len(vectors) < RAG_ANN_MIN_ROWS) or len(vectors) > 2 * self.trained_rows:
+            return build_vector_index(vectors, normalized=True)
+        return IVFIndex(vectors, normalized=True, nprobe=self.nprobe,
+                        centroids=self.centroids, trained_rows=self.trained_rows)
+
+    def append(self, new_vectors):
+        return self._derive(np.concatenate([self.vectors, normalize_rows(new_vectors)]))
+
+    def select(self, rows):
+        return self._derive(self.vectors[rows])
+
+    def arrays(self):
+        arrays = {'vectors': self.vectors, 'centroids': self.centroids, 'order': self.order, 'offsets': self.offsets}
+        return arrays, {'trained_rows': self.trained_rows}
+
+    @classmethod
+    def from_arrays(cls, arrays, params):
+        index = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        index.trained_rows = params['trained_rows']
+        index.nprobe = min(RAG_ANN_NPROBE, len(index.centroids))
+        return index
+
+def build_vector_index(vectors, normalized=False):
+    n = len(vectors)
+    if n and (RAG_ANN == 'ivf' or (RAG_ANN == 'auto' and n >= RAG_ANN_MIN_ROWS)):
+        return IVFIndex(vectors, normalized=normalized)
+    return VectorIndex(vectors, normalized=normalized)
+
+INDEX_KINDS = {cls.kind: cls for cls in (VectorIndex, IVFIndex)}
+
+# ================== TÌM KIẾM TỪ KHÓA (BM25) ==================
+# Chỉ mục đảo ngược trên các chunk, chấm điểm BM25, không cần gọi API nhúng:
+# - chuẩn hóa tiếng Việt: chữ thường, bỏ dấu ("Tam giác" = "tam giac"), đ -> d, tách theo âm tiết
+# - từ chỉ mục = âm tiết + cặp âm tiết liền nhau ("tam_giac"), nên cụm từ khớp được điểm cao hơn
+# - MATH_TERM_SYNONYMS đưa cách viết khác/viết tắt về một dạng (áp dụng cho cả tài liệu và câu hỏi)
+# Postings lưu dạng CSR (offsets/docs/weights) để ghi xuống thư mục thế hệ và mmap như vector.
+# RAG_RETRIEVAL: "vector" (chỉ embedding), "bm25" (không gọi API) hoặc "hybrid" (mặc định: gộp
+# hai bảng xếp hạng bằng Reciprocal Rank Fusion). Nhúng câu hỏi lỗi thì tự chuyển sang BM25.
+RAG_RETRIEVAL = os.getenv('RAG_RETRIEVAL', 'hybrid')
+RAG_HYBRID_CANDIDATES = int(os.getenv('RAG_HYBRID_CANDIDATES', 50))
+RAG_RRF_K = 60
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+MATH_TERM_SYNONYMS = {
+    'ty': ['ti'],                 # tỷ lệ / tỉ lệ, số hữu tỷ / số hữu tỉ
+    'pitago': ['pythagore'], 'pytago': ['pythagore'], 'pythagoras': ['pythagore'], 'pitagore': ['pythagore'],
+    'talet': ['thales'],
+    'tg': ['tam', 'giac'],
+    'hcn': ['hinh', 'chu', 'nhat'],
+    'hbh': ['hinh', 'binh', 'hanh'],
+    'pt': ['phuong', 'trinh'],
+    'bpt': ['bat', 'phuong', 'trinh'],
+    'hpt': ['he', 'phuong', 'trinh'],
+    'ucln': ['uoc', 'chung', 'lon', 'nhat'],
+    'bcnn': ['boi', 'chung', 'nho', 'nhat'],
+    'sqrt': ['can', 'bac', 'hai'],
+    'frac': ['phan', 'so'],
+}
+# Cụm từ đồng nghĩa chỉ dùng để mở rộng câu hỏi (thêm từ, không thay thế)
+MATH_QUERY_EXPANSIONS = {
+    ('binh', 'phuong'): ['luy', 'thua', 'bac', 'hai'],
+    ('lap', 'phuong'): ['luy', 'thua', 'bac', 'ba'],
+    ('can', 'hai'): ['can', 'bac', 'hai'],
+    ('ti', 'so'): ['ti', 'le'],
+    ('vuong', 'goc'): ['duong', 'vuong', 'goc'],
+}
+_WORD_RE = re.compile(r'\w+')
+_COMBINING_RE = re.compile('[\u0300-\u036f]')  # dấu thanh/dấu mũ sau khi tách NFD
+
+def fold_vietnamese(text):
+    # "Định lý Pythagore" -> "dinh ly pythagore"
+    return _COMBINING_RE.sub('', unicodedata.normalize('NFD', text.lower().replace('đ', 'd')))
+
+def tokenize_vietnamese(text, expand=False):
+    syllables = []
+    for word in _WORD_RE.findall(fold_vietnamese(text)):
+        syllables.extend(MATH_TERM_SYNONYMS.get(word, (word,)))
+    if expand:
+        extra = []
+        for i in range(len(syllables) - 1):
+            extra.extend(MATH_QUERY_EXPANSIONS.get((syllables[i], syllables[i + 1]), ()))
+        syllables += extra
+    bigrams = [f'{a}_{b}' for a, b in zip(syllables, syllables[1:])]
+    return syllables + bigrams
+
+class BM25Index:
+    kind = 'bm25'
+
+    def __init__(self, vocab, offsets, docs, tfs, doc_lens, weights=None):
+        # postings của từ thứ t: docs/tfs[offsets[t]:offsets[t + 1]] (docs tăng dần)
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        if weights is None:
+            weights = self._weights()
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def _weights(self):
+        # idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)), tính sẵn cho từng posting
+        n = len(self.doc_lens)
+        if not len(self.docs):
+            return np.zeros(0, dtype=np.float32)
+        df = np.diff(self.offsets)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = max(float(np.mean(self.doc_lens)), 1.0)
+        tf = self.tfs.astype(np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens[self.docs] / avgdl)
+        return (np.repeat(idf, df) * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32)
+
+    @classmethod
+    def build(cls, chunks, vocab=None):
+        # vocab: từ điển có sẵn (khi ghép thêm tài liệu), từ mới được thêm vào cuối
+        vocab = list(vocab or [])
+        term_ids = {term: i for i, term in enumerate(vocab)}
+        terms, docs, tfs, doc_lens = [], [], [], []
+        for doc, chunk in enumerate(chunks):
+            if doc % 256 == 255:
+                cooperative_yield()
+            counts = {}
+            tokens = tokenize_vietnamese(chunk)
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            doc_lens.append(len(tokens))
+            for token, tf in counts.items():
+                term = term_ids.get(token)
+                if term is None:
+                    term = term_ids[token] = len(vocab)
+                    vocab.append(token)
+                terms.append(term)
+                docs.append(doc)
+                tfs.append(tf)
+        return cls._from_flat(vocab, np.array(terms, dtype=np.int64), np.array(docs, dtype=np.int64),
+                              np.array(tfs, dtype=np.int32), np.array(doc_lens, dtype=np.int32))
+
+    @classmethod
+    def _from_flat(cls, vocab, terms, docs, tfs, doc_lens):
+        # Gom lại postings theo (từ, tài liệu) sau khi lọc/ghép
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        offsets = np.searchsorted(terms, np.arange(len(vocab) + 1)).astype(np.int64)
+        return cls(vocab, offsets, docs.astype(np.int32), tfs.astype(np.int32), doc_lens)
+
+    def _posting_terms(self):
+        return np.repeat(np.arange(len(self.vocab)), np.diff(self.offsets))
+
+    def select(self, rows):
+        # Giữ các tài liệu rows (đánh số lại 0..len(rows)-1) mà không cần tách từ lại
+        new_ids = np.full(len(self), -1, dtype=np.int64)
+        new_ids[rows] = np.arange(len(rows))
+        mapped = new_ids[self.docs]
+        keep = mapped >= 0
+        return BM25Index._from_flat(self.vocab, self._posting_terms()[keep], mapped[keep], self.tfs[keep],
+                                    np.asarray(self.doc_lens)[rows])
+
+    def append(self, new_chunks):
+        # Chỉ tách từ các chunk mới; từ điển cũ giữ nguyên thứ tự, từ mới thêm vào cuối
+        added = BM25Index.build(new_chunks, vocab=self.vocab)
+        return BM25Index._from_flat(
+            added.vocab,
+            np.concatenate([self._posting_terms(), added._posting_terms()]),
+            np.concatenate([self.docs, added.docs.astype(np.int64) + len(self)]),
+            np.concatenate([self.tfs, added.tfs]),
+            np.concatenate([self.doc_lens, added.doc_lens]).astype(np.int32))
+
+    def scores(self, query):
+        # Điểm BM25 của mọi tài liệu cho câu hỏi (mảng dày, 0 với tài liệu không chứa từ nào)
+        terms = [self.term_ids[t] for t in set(tokenize_vietnamese(query, expand=True)) if t in self.term_ids]
+        if not terms or not len(self):
+            return np.zeros(len(self), dtype=np.float32)
+        spans = [np.arange(self.offsets[t], self.offsets[t + 1]) for t in terms]
+        postings = np.concatenate(spans)
+        return np.bincount(self.docs[postings], weights=self.weights[postings], minlength=len(self)).astype(np.float32)
+
+    def search(self, query, top_k=3):
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores > 0)
+        if not len(matched):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        idxs, top = top_k_rows(scores[matched].reshape(1, -1), top_k)
+        return matched[idxs[0]], top[0]
+
+    def arrays(self):
+        arrays = {'offsets': self.offsets, 'docs': self.docs, 'tfs': self.tfs,
+                  'doc_lens': self.doc_lens, 'weights': self.weights}
+        return arrays, {'vocab': self.vocab}
+
+    @classmethod
+    def from_arrays(cls, arrays, params):
+        return cls(params['vocab'], arrays['offsets'], arrays['docs'], arrays['tfs'],
+                   arrays['doc_lens'], weights=arrays['weights'])
+
+def reciprocal_rank_fusion(rankings, top_k, k=RAG_RRF_K):
+    # Gộp nhiều danh sách xếp hạng: điểm = tổng 1 / (k + hạng); không cần chuẩn hóa thang điểm
+    fused = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            fused[int(doc)] = fused.get(int(doc), 0.0) + 1.0 / (k + rank + 1)
+    return np.array(sorted(fused, key=lambda doc: (-fused[doc], doc))[:top_k], dtype=np.int64)
+
+# ================== CHỈ MỤC RAG DÙNG CHUNG TRÊN ĐĨA ==================
+# Mỗi lần dựng/cập nhật ghi ra một thư mục thế hệ mới rag_cache/index/gen-000123 (vector, chunk,
+# nguồn đều là file phẳng), rồi đổi file CURRENT bằng os.replace (nguyên tử). Mọi worker
+# gunicorn mmap cùng các file đó: một bản vector trong page cache cho cả máy. Worker thấy
+# CURRENT đổi (stat mỗi request) thì nạp thế hệ mới, chỉ tốn vài lần mở file.
+# Việc dựng được khóa bằng flock, nên khi nhiều worker khởi động cùng lúc chỉ một worker nhúng.
+RAG_INDEX_DIR = os.getenv('RAG_INDEX_DIR', './rag_cache/index')
+RAG_INDEX_FORMAT = 3
+RAG_KEEP_GENERATIONS = 2  # giữ thêm thế hệ trước cho worker đang đọc dở
+RAG_CURRENT_PATH = os.path.join(RAG_INDEX_DIR, 'CURRENT')
+_RAG_CURRENT_STAMP = None  # (inode, mtime) của CURRENT lần nạp gần nhất
+
+class MappedChunks:
+    # Danh sách chunk chỉ đọc trên file mmap: chunks.bin (UTF-8 nối liền) + offsets.npy
+    def __init__(self, data_path, offsets_path):
+        self.offsets = _load_array(offsets_path)
+        with open(data_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+def _load_array(path):
     try:
-        embeddings = embed_with_retry(chunks, EMBEDDING_MODEL)
-        RAG_DATA.update({
-            "chunks": chunks,
-            "embeddings": embeddings,
-            "is_ready": True
-        })
-        print("🎉 Khởi tạo RAG hoàn tất!")
-    except Exception as e:
-        print(f"❌ KHÔNG THỂ KHỞI TẠO RAG: {e}")
-        RAG_DATA["is_ready"] = False
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)  # mảng rỗng: không mmap được file 0 byte dữ liệu
 
-initialize_rag_data()
+@contextmanager
+def rag_build_lock():
+    # Chỉ một process dựng/cập nhật chỉ mục tại một thời điểm (xem exclusive_file_lock)
+    os.makedirs(RAG_INDEX_DIR, exist_ok=True)
+    with exclusive_file_lock(os.path.join(RAG_INDEX_DIR, '.lock')):
+        yield
+
+def pdf_fingerprint(directory):
+    # Danh sách (tên, kích thước, mtime) để biết chỉ mục trên đĩa còn khớp thư mục PDF không
+    if not os.path.exists(directory):
+        return []
+    files = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.pdf'):
+            st = os.stat(os.path.join(directory, filename))
+            files.append([filename, st.st_size, st.st_mtime_ns])
+    return files
+
+def _read_current():
+    try:
+        st = os.stat(RAG_CURRENT_PATH)
+        with open(RAG_CURRENT_PATH, encoding='utf-8') as f:
+            return f.read().strip(), (st.st_ino, st.st_mtime_ns)
+    except FileNotFoundError:
+        return None, None
+
+def write_rag_generation(chunks, index, bm25, source_ids, chunk_meta, source_names, files):
+    # Ghi một thế hệ mới vào thư mục tạm, đổi tên, rồi trỏ CURRENT sang. Gọi khi đang giữ rag_build_lock().
+    current, _ = _read_current()
+    generation = int(current.split('-')[1]) + 1 if current else 1
+    name = f'gen-{generation:06d}'
+    final_dir = os.path.join(RAG_INDEX_DIR, name)
+    tmp_dir = f'{final_dir}.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir)
+
+    offsets = [0]
+    with open(os.path.join(tmp_dir, 'chunks.bin'), 'wb') as f:
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'source_ids.npy'), np.asarray(source_ids, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, 'chunk_meta.npy'), np.asarray(chunk_meta, dtype=np.int64).reshape(-1, 3))
+    arrays, params = index.arrays()
+    for array_name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f'index_{array_name}.npy'), np.ascontiguousarray(array))
+    bm25_arrays, bm25_params = bm25.arrays()
+    for array_name, array in bm25_arrays.items():
+        np.save(os.path.join(tmp_dir, f'bm25_{array_name}.npy'), np.ascontiguousarray(array))
+    meta = {
+        'format': RAG_INDEX_FORMAT,
+        'generation': generation,
+        'embedding_model': EMBEDDING_MODEL,
+        'kind': index.kind,
+        'params': params,
+        'arrays': sorted(arrays),
+        'bm25': {'arrays': sorted(bm25_arrays), 'params': bm25_params},
+        'source_names': source_names,
+        'files': files,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.rename(tmp_dir, final_dir)
+
+    tmp_current = f'{RAG_CURRENT_PATH}.tmp-{os.getpid()}'
+    with open(tmp_current, 'w', encoding='utf-8') as f:
+        f.write(name)
+    os.replace(tmp_current, RAG_CURRENT_PATH)
+
+    # Dọn các thế hệ cũ: worker còn mmap file cũ vẫn đọc được (inode chỉ bị xóa khi đóng)
+    generations = sorted(d for d in os.listdir(RAG_INDEX_DIR) if d.startswith('gen-'))
+    for old in generations[:-RAG_KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(RAG_INDEX_DIR, old), ignore_errors=True)
+    return name
+
+def load_rag_generation(name):
+    # Nạp một thế hệ: chỉ mở file và mmap, không sao chép vector
+    path = os.path.join(RAG_INDEX_DIR, name)
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('format') != RAG_INDEX_FORMAT or meta.get('embedding_model') != EMBEDDING_MODEL:
+        return None
+    arrays = {array_name: _load_array(os.path.join(path, f'index_{array_name}.npy')) for array_name in meta['arrays']}
+    bm25_arrays = {array_name: _load_array(os.path.join(path, f'bm25_{array_name}.npy'))
+                   for array_name in meta['bm25']['arrays']}
+    return {
+        "name": name,
+        "chunks": MappedChunks(os.path.join(path, 'chunks.bin'), os.path.join(path, 'offsets.npy')),
+        "index": INDEX_KINDS[meta['kind']].from_arrays(arrays, meta['params']),
+        "bm25": BM25Index.from_arrays(bm25_arrays, meta['bm25']['params']),
+        "source_ids": _load_array(os.path.join(path, 'source_ids.npy')),
+        "chunk_meta": _load_array(os.path.join(path, 'chunk_meta.npy')),
+        "source_names": meta['source_names'],
+        "files": meta['files'],
+        "generation": meta['generation'],
+    }
+
+def publish_rag_data(snapshot, stamp):
+    global RAG_DATA, _RAG_CURRENT_STAMP
+    RAG_DATA = {
+        "chunks": snapshot["chunks"],
+        "embeddings": snapshot["index"].vectors,
+        "index": snapshot["index"],
+        "bm25": snapshot["bm25"],
+        "source_ids": snapshot["source_ids"],
+        "chunk_meta": snapshot["chunk_meta"],
+        "source_names": snapshot["source_names"],
+        "files": snapshot["files"],
+        "name": snapshot["name"],
+        "generation": snapshot["generation"],
+        "is_ready": len(snapshot["chunks"]) > 0
+    }
+    _RAG_CURRENT_STAMP = stamp
+    # Corpus đã đổi: câu trả lời cũ có thể dựa trên tài liệu không còn nữa
+    ANSWER_CACHE.clear()
+
+def _save_and_publish(chunks, index, bm25, source_ids, chunk_meta, source_names, directory, files=None):
+    # files: các file PDF mà chỉ mục này phản ánh (mặc định cả thư mục)
+    if files is None:
+        files = pdf_fingerprint(directory)
+    name = write_rag_generation(chunks, index, bm25, source_ids, chunk_meta, source_names, files)
+    _, stamp = _read_current()
+    publish_rag_data(load_rag_generation(name), stamp)
+
+def refresh_rag_data(block=False):
+    # Nạp thế hệ mới nếu worker khác vừa cập nhật chỉ mục; rẻ khi không có gì đổi (một lần stat)
+    global _RAG_CURRENT_STAMP
+    try:
+        st = os.stat(RAG_CURRENT_PATH)
+    except FileNotFoundError:
+        return False
+    if (st.st_ino, st.st_mtime_ns) == _RAG_CURRENT_STAMP:
+        return False
+    if not RAG_WRITE_LOCK.acquire(blocking=block):
+        return False  # đang có luồng cập nhật, request này dùng snapshot hiện tại
+    try:
+        name, stamp = _read_current()
+        if name is None or stamp == _RAG_CURRENT_STAMP:
+            return False
+        if name == RAG_DATA["name"]:
+            _RAG_CURRENT_STAMP = stamp  # chính worker này vừa ghi
+            return False
+        snapshot = load_rag_generation(name)
+        if snapshot is None:
+            return False
+        publish_rag_data(snapshot, stamp)
+        print(f"🔄 Đã nạp chỉ mục RAG {name} ({len(snapshot['chunks'])} chunks)")
+        return True
+    except (OSError, ValueError, KeyError) as e:
+        print(f"❌ Không nạp được chỉ mục RAG: {e}")
+        return False
+    finally:
+        RAG_WRITE_LOCK.release()
+
+def initialize_rag_data(directory='./static'):
+    # -> trạng thái cuối: "ready", "stale" (dùng tạm chỉ mục cũ trên đĩa) hoặc "failed".
+    # Tiến độ từng bước được ghi vào STARTUP_STATUS cho /readyz.
+    print("⏳ Đang khởi tạo dữ liệu RAG...")
+    STARTUP_STATUS["rag"] = "loading"
+    with RAG_WRITE_LOCK, rag_build_lock():
+        # Worker khác (hoặc lần chạy trước) đã dựng chỉ mục khớp thư mục PDF: chỉ cần mmap
+        name, stamp = _read_current()
+        snapshot = None
+        if name:
+            try:
+                snapshot = load_rag_generation(name)
+            except (OSError, ValueError, KeyError):
+                snapshot = None
+            if snapshot is not None and snapshot["files"] == pdf_fingerprint(directory):
+                publish_rag_data(snapshot, stamp)
+                STARTUP_STATUS.update(rag="ready", files=len(snapshot["source_names"]), chunks=len(snapshot["chunks"]))
+                print(f"♻️ Dùng lại chỉ mục RAG {name} ({len(snapshot['chunks'])} chunks)")
+                return "ready"
+
+        STARTUP_STATUS["rag"] = "extracting"
+        chunks, sources, chunk_meta = create_chunks_from_directory(directory)
+        source_names = sorted(set(sources))
+        name_ids = {src: i for i, src in enumerate(source_names)}
+        source_ids = [name_ids[src] for src in sources]
+        STARTUP_STATUS.update(files=len(source_names), chunks=len(chunks))
+        try:
+            if not chunks:
+                print("Không có dữ liệu để nhúng.")
+                STARTUP_STATUS["rag"] = "writing"
+                _save_and_publish([], build_vector_index(np.array([])), BM25Index.build([]), [], [], [], directory)
+                STARTUP_STATUS["rag"] = "ready"
+                return "ready"
+            STARTUP_STATUS["rag"] = "embedding"
+            index = build_vector_index(embed_with_cache(chunks, EMBEDDING_MODEL))
+            STARTUP_STATUS["rag"] = "writing"
+            _save_and_publish(chunks, index, BM25Index.build(chunks), source_ids, chunk_meta,
+                              source_names, directory)
+            STARTUP_STATUS["rag"] = "ready"
+            print(f"🎉 Khởi tạo RAG hoàn tất! ({len(index)} vector, chỉ mục {index.kind}, {RAG_DATA['name']})")
+            return "ready"
+        except Exception as e:
+            print(f"❌ KHÔNG THỂ KHỞI TẠO RAG: {e}")
+            STARTUP_STATUS["error"] = f"rag: {e}"
+            if snapshot is not None:
+                # Tài liệu đã đổi nhưng API nhúng lỗi: phục vụ tạm bằng chỉ mục cũ thay vì không có gì
+                publish_rag_data(snapshot, stamp)
+                STARTUP_STATUS["rag"] = "stale"
+                print(f"⚠️ Tạm dùng chỉ mục RAG cũ {name}")
+                return "stale"
+            STARTUP_STATUS["rag"] = "failed"
+            return "failed"
+
+def _without_source(data, filename):
+    # -> (chunks, index, bm25, source_ids, chunk_meta, source_names) sau khi bỏ các dòng của filename
+    # index/bm25 là None khi chưa có thế hệ nào trên đĩa
+    if data["index"] is None:
+        return [], None, None, np.array([], dtype=np.int32), np.zeros((0, 3), dtype=np.int64), []
+    names = list(data["source_names"])
+    if filename not in names:
+        return (data["chunks"], data["index"], data["bm25"], np.asarray(data["source_ids"]),
+                np.asarray(data["chunk_meta"]), names)
+    source_id = names.index(filename)
+    keep = np.flatnonzero(np.asarray(data["source_ids"]) != source_id)
+    source_ids = np.asarray(data["source_ids"])[keep]
+    source_ids[source_ids > source_id] -= 1
+    del names[source_id]
+    return ([data["chunks"][i] for i in keep], data["index"].select(keep), data["bm25"].select(keep), source_ids,
+            np.asarray(data["chunk_meta"])[keep], names)
+
+def add_pdf_to_rag(filename, directory='./static'):
+    # Chỉ trích xuất và nhúng file mới; các dòng của file khác được giữ nguyên
+    print(f"⏳ Đang thêm {filename} vào RAG...")
+    with RAG_WRITE_LOCK, rag_build_lock():
+        new_chunks, new_meta = create_chunks_from_pdf(directory, filename)
+        if not new_chunks:
+            print(f"Không có nội dung để nhúng trong {filename}.")
+            return
+        try:
+            new_embeddings = embed_with_cache(new_chunks, EMBEDDING_MODEL)
+        except Exception as e:
+            print(f"❌ Không thể nhúng {filename}: {e}")
+            return
+        # Bắt đầu từ thế hệ mới nhất trên đĩa (worker khác có thể vừa cập nhật)
+        data = _latest_rag_data()
+        # Upload đè file cùng tên: bỏ các dòng cũ của file đó trước
+        chunks, index, bm25, source_ids, chunk_meta, names = _without_source(data, filename)
+        names.append(filename)
+        source_ids = np.concatenate([source_ids, np.full(len(new_chunks), len(names) - 1, dtype=np.int32)])
+        chunk_meta = np.concatenate([chunk_meta.reshape(-1, 3), np.asarray(new_meta, dtype=np.int64)])
+        if index is None:
+            # Chưa có thế hệ nào (upload đầu tiên, hoặc lần dựng trước lỗi): chỉ mục mới chỉ gồm file
+            # này. Ghi đúng danh sách file đó để lần dựng lại khi khởi động vẫn thấy các PDF khác còn thiếu.
+            index, bm25 = build_vector_index(new_embeddings), BM25Index.build(new_chunks)
+            files = [entry for entry in pdf_fingerprint(directory) if entry[0] == filename]
+        else:
+            index, bm25, files = index.append(new_embeddings), bm25.append(new_chunks), None
+        _save_and_publish(list(chunks) + new_chunks, index, bm25, source_ids, chunk_meta, names, directory, files)
+        print(f"🎉 Đã thêm {len(new_chunks)} chunks của {filename} vào RAG ({RAG_DATA['name']}).")
+
+def remove_pdf_from_rag(filename, directory='./static'):
+    # Bỏ các dòng của file khỏi chỉ mục rồi mới xóa file (chạy nền, xem delete_pdf): cập nhật chỉ mục
+    # lỗi thì file vẫn còn, chỉ mục vẫn khớp thư mục và admin có thể xóa lại
+    with RAG_WRITE_LOCK, rag_build_lock():
+        try:
+            chunks, index, bm25, source_ids, chunk_meta, names = _without_source(_latest_rag_data(), filename)
+            if index is not None:
+                files = [entry for entry in pdf_fingerprint(directory) if entry[0] != filename]
+                _save_and_publish(list(chunks), index, bm25, source_ids, chunk_meta, names, directory, files)
+        except Exception as e:
+            print(f"❌ Không thể xóa {filename} khỏi RAG, giữ nguyên file: {e}")
+            return
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+        print(f"🗑️ Đã xóa {filename} khỏi RAG, còn {len(chunks)} chunks.")
+
+def _latest_rag_data():
+    # Gọi khi đang giữ cả hai khóa: snapshot của thế hệ CURRENT trên đĩa
+    name, stamp = _read_current()
+    if name and name != RAG_DATA["name"]:
+        snapshot = load_rag_generation(name)
+        if snapshot is not None:
+            publish_rag_data(snapshot, stamp)
+    return RAG_DATA
 
 # ================== TRUY XUẤT NGỮ CẢNH ==================
+def search_rag(queries, top_k=3):
+    # -> (snapshot, vector câu hỏi, chỉ số các chunk top-k cho từng câu hỏi)
+    # query_vecs là None khi không nhúng câu hỏi (chế độ bm25 hoặc API nhúng lỗi)
+    refresh_rag_data()
+    data = RAG_DATA  # đọc snapshot một lần, không bị ảnh hưởng bởi cập nhật song song
+    if not data["is_ready"]:
+        return data, None, None
+    queries = list(queries)
+    mode = RAG_RETRIEVAL
+    query_vecs = None
+    if mode != 'bm25':
+        try:
+            query_vecs = embed_queries(queries)
+        except Exception as e:
+            if data["bm25"] is None:
+                raise
+            print(f"⚠️ Không nhúng được câu hỏi, tìm bằng BM25: {e}")
+            mode = 'bm25'
+    RETRIEVAL_REQUESTS.inc(mode if mode == RAG_RETRIEVAL else f'{mode}_fallback')
+    with stage('search'):
+        if mode == 'vector':
+            top_idxs, _ = data["index"].search_batch(query_vecs, top_k)
+        elif mode == 'bm25':
+            top_idxs = [data["bm25"].search(q, top_k)[0] for q in queries]
+        else:
+            candidates = max(top_k, RAG_HYBRID_CANDIDATES)
+            vector_idxs, _ = data["index"].search_batch(query_vecs, candidates)
+            top_idxs = [reciprocal_rank_fusion([vec_ids, data["bm25"].search(q, candidates)[0]], top_k)
+                        for q, vec_ids in zip(queries, vector_idxs)]
+    return data, query_vecs, top_idxs
+
+def _source_label(data, first, last):
+    name = data["source_names"][int(data["source_ids"][first])]
+    page, last_page = int(data["chunk_meta"][first][0]), int(data["chunk_meta"][last][0])
+    pages = f"trang {page}" if page == last_page else f"trang {page}–{last_page}"
+    return f"[Nguồn: {name}, {pages}]"
+
+def _merge_run(data, run):
+    # Nối các chunk liền nhau của cùng một file theo vị trí: phần chồng lấn chỉ giữ một lần
+    meta = data["chunk_meta"]
+    text = data["chunks"][run[0]]
+    end = int(meta[run[0]][2])
+    for i in run[1:]:
+        start_i, end_i = int(meta[i][1]), int(meta[i][2])
+        if end_i <= end:
+            continue
+        chunk = data["chunks"][i]
+        text += chunk[end - start_i:] if start_i <= end else "\n" + chunk
+        end = end_i
+    return text
+
+def merge_hits(data, idxs):
+    # -> các đoạn ngữ cảnh theo thứ hạng của hit tốt nhất trong đoạn. Hit kề nhau (cùng file,
+    # chỉ số liên tiếp: chunk của một file luôn nằm liền nhau) được gộp thành một đoạn dày hơn,
+    # đoạn trùng nội dung (cùng tài liệu upload hai lần) bị bỏ. Mỗi đoạn có nhãn nguồn + trang.
+    idxs = [int(i) for i in idxs]
+    hits = set(idxs)
+    source_ids = data["source_ids"]
+    used, seen_texts, passages = set(), set(), []
+    for i in idxs:
+        if i in used:
+            continue
+        first, last = i, i
+        while first - 1 in hits and source_ids[first - 1] == source_ids[i]:
+            first -= 1
+        while last + 1 in hits and source_ids[last + 1] == source_ids[i]:
+            last += 1
+        run = range(first, last + 1)
+        used.update(run)
+        text = _merge_run(data, run)
+        if text in seen_texts:
+            continue
+        seen_texts.add(text)
+        passages.append(f"{_source_label(data, first, last)}\n{text}")
+    return passages
+
+def retrieve_contexts(queries, top_k=3):
+    # Nhúng và chấm điểm nhiều câu hỏi trong một lượt
+    try:
+        data, _, top_idxs = search_rag(queries, top_k)
+        if top_idxs is None:
+            return ["Không có tài liệu RAG nào được tải."] * len(queries)
+        return ["\n\n---\n\n".join(merge_hits(data, idxs)) for idxs in top_idxs]
+    except Exception as e:
+        print(f"❌ Lỗi RAG: {e}")
+        return ["Lỗi khi tìm kiếm ngữ cảnh."] * len(queries)
+
 def retrieve_context(query, top_k=3):
-    if not RAG_DATA["is_ready"]:
-        return "Không có tài liệu RAG nào được tải."
+    return retrieve_contexts([query], top_k)[0]
+
+def retrieve_context_for_chat(query, top_k=3):
+    # Như retrieve_context nhưng trả danh sách đoạn đã gộp (tốt nhất trước, để cắt theo ngân sách token),
+    # kèm vector câu hỏi và khóa bucket cho ANSWER_CACHE
     try:
-        query_vec = embed_with_retry([query], EMBEDDING_MODEL)[0].reshape(1, -1)
-        sims = cosine_similarity(query_vec, RAG_DATA["embeddings"])[0]
-        top_idxs = np.argsort(sims)[-top_k:][::-1]
-        return "\n\n---\n\n".join([RAG_DATA["chunks"][i] for i in top_idxs])
+        data, query_vecs, top_idxs = search_rag([query], top_k)
+        if top_idxs is None:
+            return ["Không có tài liệu RAG nào được tải."], None, None
+        idxs = top_idxs[0]
+        chunks = merge_hits(data, idxs)
+        if query_vecs is None:
+            return chunks, None, None  # không có vector: bỏ qua ANSWER_CACHE
+        return chunks, query_vecs[0], (data["generation"], tuple(int(i) for i in idxs))
     except Exception as e:
         print(f"❌ Lỗi RAG: {e}")
-        return "Lỗi khi tìm kiếm ngữ cảnh."
+        return ["Lỗi khi tìm kiếm ngữ cảnh."], None, None
 
 # ================== ĐÁNH GIÁ NĂNG LỰC ==================
-def evaluate_student_level(history):
+def evaluate_student_level(history, raise_errors=False):
     recent_questions = "\n".join([msg for msg in history[-10:] if msg.startswith("👧 Học sinh:")])
     prompt = f"""
     Bạn là một **Giáo viên Toán THCS Song ngữ (Anh – Việt)**, có nhiệm vụ **đánh giá năng lực học tập và khả năng tự học của học sinh** dựa trên lịch sử câu hỏi gần đây.
@@ -187,9 +2364,8 @@ def evaluate_student_level(history):
     """
 
     try:
-        model = genai.GenerativeModel(GENERATION_MODEL)
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
+        with stage('evaluate'):
+            response_text = MODEL_CLIENT.generate(prompt).strip()
         # Extract level and reason from response
         level_match = re.search(r'Cấp độ: (Giỏi|Khá|Đạt yêu cầu|Chưa đạt)', response_text)
         lydo_match = re.search(r'Lý do:\s*(.+)', response_text, re.DOTALL)
@@ -202,36 +2378,374 @@ def evaluate_student_level(history):
         return level, lydo
     except Exception as e:
         print(f"❌ Lỗi đánh giá: {e}")
+        if raise_errors:
+            raise
         return 'Đạt yêu cầu', 'Đánh giá không thành công do lỗi hệ thống.'
 
+# ================== HÀNG ĐỢI ĐÁNH GIÁ NỀN ==================
+# /chat chỉ ghi một job vào bảng danhgia_jobs rồi trả lời ngay; EVAL_WORKERS luồng nền
+# lấy job từ hàng đợi cục bộ, gọi evaluate_student_level và cập nhật level/lydo.
+# Mỗi học sinh chỉ có tối đa một job đang chờ/đang chạy (unique index một phần).
+# Job lỗi được thử lại tối đa EVAL_MAX_ATTEMPTS lần với backoff; job còn dang dở khi
+# tiến trình dừng sẽ được nạp lại lúc khởi động (recover_evaluation_jobs).
+# Job "running" ghi tên tiến trình chạy nó (owner) và chỉ được giành lại khi tiến trình đó đã
+# chết (cùng máy) hoặc quá EVAL_LEASE giây chưa xong; nên phải lớn hơn MODEL_TIMEOUT.
+EVAL_WORKERS = int(os.getenv('EVAL_WORKERS', 2))
+EVAL_MAX_ATTEMPTS = int(os.getenv('EVAL_MAX_ATTEMPTS', 3))
+EVAL_RETRY_DELAY = float(os.getenv('EVAL_RETRY_DELAY', 30))
+EVAL_LEASE = float(os.getenv('EVAL_LEASE', 300))
+EVAL_QUEUE = queue.Queue()
+_eval_workers = {"pid": None, "threads": []}
+_eval_workers_lock = threading.Lock()
+
+def _job_owner():
+    # Gọi mỗi lần (không lưu lúc import): gunicorn fork worker sau khi import app
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _owner_is_dead(owner):
+    # True chỉ khi chắc chắn: tiến trình cùng máy và pid không còn tồn tại
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass  # còn sống nhưng thuộc user khác
+    return False
+
+def _ensure_eval_workers():
+    # Khởi động luồng nền lười (và khởi động lại sau khi gunicorn fork tiến trình)
+    with _eval_workers_lock:
+        if _eval_workers["pid"] == os.getpid() and all(t.is_alive() for t in _eval_workers["threads"]):
+            return
+        _eval_workers["pid"] = os.getpid()
+        _eval_workers["threads"] = [
+            threading.Thread(target=_evaluation_worker, name=f"eval-worker-{i}", daemon=True)
+            for i in range(EVAL_WORKERS)
+        ]
+        for t in _eval_workers["threads"]:
+            t.start()
+
+def _schedule_evaluation(job_id, delay=0):
+    _ensure_eval_workers()
+    if delay > 0:
+        timer = threading.Timer(delay, EVAL_QUEUE.put, args=(job_id,))
+        timer.daemon = True
+        timer.start()
+    else:
+        EVAL_QUEUE.put(job_id)
+
+def enqueue_evaluation(user_id):
+    # Tạo job đánh giá cho học sinh; trả về None nếu học sinh đã có job đang chờ/chạy
+    job = EvaluationJob(user_id=user_id)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    _schedule_evaluation(job.id)
+    return job
+
+def enqueue_bulk_evaluation(user_ids):
+    queued = 0
+    for user_id in user_ids:
+        if enqueue_evaluation(user_id) is not None:
+            queued += 1
+    return queued
+
+def run_evaluation_job(job_id):
+    # Giành quyền chạy job: chỉ một luồng/tiến trình đổi được pending -> running
+    claimed = db.session.execute(
+        db.update(EvaluationJob)
+        .where(EvaluationJob.id == job_id, EvaluationJob.status == 'pending')
+        .values(status='running', attempts=EvaluationJob.attempts + 1, owner=_job_owner(), updated_at=utcnow())
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+    job = db.session.get(EvaluationJob, job_id)
+    user = db.session.get(User, job.user_id)
+    if not user:
+        db.session.delete(job)
+        db.session.commit()
+        return
+    try:
+        history = recent_student_questions(user.id, limit=10)
+        new_level, lydo = evaluate_student_level(history, raise_errors=True)
+    except Exception as e:
+        job.last_error = str(e)
+        job.updated_at = utcnow()
+        if job.attempts < EVAL_MAX_ATTEMPTS:
+            job.status = 'pending'
+            db.session.commit()
+            _schedule_evaluation(job.id, delay=EVAL_RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'failed'
+            db.session.commit()
+            print(f"💥 Đánh giá học sinh {user.username} thất bại sau {job.attempts} lần: {e}")
+        return
+    user.level = new_level
+    user.lydo = lydo  # lưu lý do vào cột lydo
+    job.status = 'done'
+    job.last_error = ''
+    job.updated_at = utcnow()
+    db.session.commit()
+    print(f"User {user.username} level updated to {new_level} with reason: {lydo}")
+
+def _evaluation_worker():
+    while True:
+        job_id = EVAL_QUEUE.get()
+        with app.app_context():
+            try:
+                run_evaluation_job(job_id)
+            except Exception as e:
+                db.session.rollback()
+                print(f"❌ Lỗi job đánh giá {job_id}: {e}")
+            finally:
+                db.session.remove()
+
+def recover_evaluation_jobs():
+    # Chạy ở mọi worker mỗi lần khởi động (kể cả khi chỉ một worker được gunicorn khởi động lại),
+    # nên chỉ giành lại job "running" của tiến trình đã chết hoặc đã hết hạn EVAL_LEASE; job mà
+    # worker anh em đang chạy thì để nguyên. Sau đó nạp lại các job pending vào hàng đợi.
+    expired = utcnow() - timedelta(seconds=EVAL_LEASE)
+    running = db.session.execute(db.select(EvaluationJob.id, EvaluationJob.owner, EvaluationJob.updated_at)
+                                 .where(EvaluationJob.status == 'running')).all()
+    for job_id, owner, updated_at in running:
+        if updated_at < expired or _owner_is_dead(owner):
+            # updated_at không đổi: job chưa bị tiến trình khác giành lại trong lúc này
+            db.session.execute(db.update(EvaluationJob)
+                               .where(EvaluationJob.id == job_id, EvaluationJob.status == 'running',
+                                      EvaluationJob.updated_at == updated_at)
+                               .values(status='pending', owner=None, updated_at=utcnow()))
+    db.session.commit()
+    job_ids = db.session.scalars(db.select(EvaluationJob.id).where(EvaluationJob.status == 'pending')).all()
+    for job_id in job_ids:
+        _schedule_evaluation(job_id)
+    if job_ids:
+        print(f"🔁 Đã nạp lại {len(job_ids)} job đánh giá đang chờ")
+
+# ================== KHỞI ĐỘNG NỀN ==================
+# Import app.py không chờ CSDL hay RAG: một luồng nền tạo bảng, nạp lại job đánh giá rồi
+# nạp/dựng chỉ mục RAG. /healthz chỉ cho biết process còn sống; /readyz trả 503 kèm
+# tiến độ cho tới khi xong (load balancer chỉ chuyển request khi đã sẵn sàng).
+# STARTUP_WARMUP=0 để tắt (benchmark, lệnh CLI) rồi tự gọi start_warmup()/warmup().
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', '1') != '0'
+STARTUP_RAG_RETRY = float(os.getenv('STARTUP_RAG_RETRY', 30))
+STARTUP_DB_RETRY = float(os.getenv('STARTUP_DB_RETRY', 2))
+STARTUP_STATUS = {
+    "db": "pending",         # pending / ready / failed (đang thử lại)
+    "rag": "pending",        # pending / loading / extracting / embedding / writing / ready / failed
+    "files": 0,
+    "chunks": 0,
+    "error": None,
+    "started_at": time.time(),
+    "ready_at": None,
+}
+_WARMUP_THREAD = None
+
+def warmup_database():
+    try:
+        if MODEL.name == 'gemini':
+            get_genai()  # import trước để request đầu tiên không phải chờ
+        init_db()
+        with app.app_context():
+            recover_evaluation_jobs()
+    except Exception as e:
+        STARTUP_STATUS.update(db="failed", error=f"db: {e}")
+        print(f"❌ Không khởi tạo được CSDL: {e}")
+        return False
+    STARTUP_STATUS["db"] = "ready"
+    if (STARTUP_STATUS["error"] or "").startswith("db:"):
+        STARTUP_STATUS["error"] = None
+    return True
+
+def warmup():
+    # CSDL chưa lên hoặc lỗi tạm thời: thử lại với backoff, /readyz báo lỗi trong lúc chờ
+    delay = STARTUP_DB_RETRY
+    while not warmup_database():
+        time.sleep(delay)
+        delay = min(delay * 2, 300)
+    # API nhúng lỗi lúc khởi động: thử lại định kỳ trong nền, process vẫn sống và /readyz báo lỗi
+    delay = STARTUP_RAG_RETRY
+    while initialize_rag_data(app.config['UPLOAD_FOLDER']) == "failed":
+        time.sleep(delay)
+        delay = min(delay * 2, 600)
+    STARTUP_STATUS["ready_at"] = time.time()
+    print(f"🚀 Sẵn sàng sau {STARTUP_STATUS['ready_at'] - STARTUP_STATUS['started_at']:.2f}s")
+
+def start_warmup():
+    global _WARMUP_THREAD
+    if _WARMUP_THREAD is None:
+        STARTUP_STATUS["started_at"] = time.time()
+        _WARMUP_THREAD = threading.Thread(target=warmup, name='startup-warmup', daemon=True)
+        _WARMUP_THREAD.start()
+    return _WARMUP_THREAD
+
+def is_ready():
+    return STARTUP_STATUS["ready_at"] is not None
+
+# Tiến trình con của process pool trích xuất PDF (forkserver/spawn) nạp lại module __main__ của
+# process cha; khi chạy "python app.py" đó là chính file này, không được khởi động thêm warmup
+if STARTUP_WARMUP and multiprocessing.parent_process() is None:
+    start_warmup()
+
+
+def generate_answer(prompt, user_message, query_vec, chunk_key, student_level):
+    # Dùng lại câu trả lời đã cache nếu câu hỏi đủ giống, cùng tài liệu và cùng năng lực
+    bucket = (chunk_key, student_level) if chunk_key is not None else None
+    if bucket is not None:
+        cached = ANSWER_CACHE.get(query_vec, bucket)
+        if cached is not None:
+            return cached
+    normalized = normalize_query(user_message)
+
+    def _generate():
+        with stage('generate'):
+            ai_text = MODEL_CLIENT.generate(prompt, system=TUTOR_SYSTEM_INSTRUCTION)
+        if bucket is not None:
+            ANSWER_CACHE.set(query_vec, bucket, normalized, ai_text)
+        return ai_text
+    # Khóa luôn có năng lực học sinh: khi chưa có chunk_key (RAG chưa sẵn sàng, chỉ BM25/dự phòng)
+    # bucket là None, nếu chỉ dùng (câu hỏi, bucket) hai học sinh khác năng lực sẽ nhận chung một câu trả lời
+    return ANSWER_FLIGHTS.do((normalized, chunk_key, student_level), _generate)
+
 
 # ================== ĐỊNH DẠNG TRẢ LỜI ==================
+# Mọi regex được biên dịch một lần khi import. LaTeX được tách ra trong một lượt quét,
+# còn highlight_terms được tìm trong một lượt quét duy nhất bằng một regex dạng trie
+# (các từ khóa chung tiền tố dùng chung nhánh, kiểu Aho-Corasick) thay vì một lần
+# str.replace trên toàn bộ câu trả lời cho mỗi từ khóa.
+_DISPLAY_LATEX_RE = re.compile(r'\$\$[^$]+\$\$')
+_INLINE_LATEX_RE = re.compile(r'\$[^$]+\$')
+_LATEX_PLACEHOLDER_RE = re.compile(r'__LATEX_(\d+)__')
+_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+_ITALIC_RE = re.compile(r'(?<!\n)\*(?!\s)(.*?)(?<!\s)\*(?!\*)')
+_BULLET_RE = re.compile(r'(?m)^\s*\*\s+(.*)')
+HIGHLIGHT_TEMPLATE = '<span style="line-height:1.6; background:{color}; color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">{term}</span>'
+
+def _trie_pattern(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != '']
+        if not alts:
+            return ''
+        body = alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+        # Nhánh kết thúc một từ khóa nhưng còn đi tiếp được: phần sau là tùy chọn (ưu tiên dài hơn)
+        return f'(?:{body})?' if '' in node else body
+    return build(trie)
+
+def _terms_are_independent(replacements):
+    # Một lượt quét (chọn từ khóa xuất hiện sớm nhất) cho kết quả giống hệt chuỗi str.replace
+    # tuần tự theo thứ tự từ điển khi: không từ khóa nào chứa từ khóa khác hay xuất hiện trong
+    # thẻ <span> chèn vào, và không có từ khóa đứng sau nào mà phần đuôi trùng phần đầu của
+    # một từ khóa đứng trước (khi đó bản tuần tự sẽ ưu tiên từ khóa đứng sau trong câu).
+    terms = list(replacements)
+    for i, a in enumerate(terms):
+        if '<' in a or '>' in a:
+            return False
+        for j, b in enumerate(terms):
+            if i == j:
+                continue
+            if a in b or a in replacements[b]:
+                return False
+            if j > i and any(b[-k:] == a[:k] for k in range(1, min(len(a), len(b)))):
+                return False
+    return True
+
+class ResponseFormatter:
+    def __init__(self, terms):
+        self.replacements = {term: HIGHLIGHT_TEMPLATE.format(color=color, term=term) for term, color in terms.items()}
+        self.terms_re = re.compile(_trie_pattern(self.replacements)) if self.replacements else None
+        self.single_pass = _terms_are_independent(self.replacements)
+
+    def _highlight(self, formatted):
+        if self.terms_re is None:
+            return formatted
+        if self.single_pass:
+            return self.terms_re.sub(lambda m: self.replacements[m.group(0)], formatted)
+        for term, replacement in self.replacements.items():
+            formatted = formatted.replace(term, replacement)
+        return formatted
+
+    def format(self, response):
+        # Bảo vệ cú pháp LaTeX bằng placeholder: $$...$$ trước, rồi $...$ (cùng thứ tự ghép cặp
+        # với bản cũ, vd. "$a $$b$$" vẫn là $$b$$ chứ không phải "$a $")
+        latex_matches = []
+        def restore_latex(match):
+            i = int(match.group(1))
+            return latex_matches[i] if i < len(latex_matches) else match.group(0)
+        def store_display(match):
+            latex_matches.append(match.group(0))
+            return f"__LATEX_{len(latex_matches)-1}__"
+        def store_inline(match):
+            # $...$ có thể bao trọn placeholder của một $$...$$ (vd. "$a$$b$$c$"): khôi phục luôn
+            # phần bên trong, nếu không placeholder sẽ lọt ra HTML
+            latex_matches.append(_LATEX_PLACEHOLDER_RE.sub(restore_latex, match.group(0)))
+            return f"__LATEX_{len(latex_matches)-1}__"
+        response = _DISPLAY_LATEX_RE.sub(store_display, response)
+        response = _INLINE_LATEX_RE.sub(store_inline, response)
+
+        # Áp dụng định dạng Markdown
+        formatted = _BOLD_RE.sub(r'<strong style="font-weight:700;">\1</strong>', response)
+        formatted = _ITALIC_RE.sub(r'<em style="font-style:italic;">\1</em>', formatted)
+        formatted = _BULLET_RE.sub(r'• <span style="line-height:1.6;">\1</span>', formatted)
+        formatted = formatted.replace('\n', '<br>')
+
+        # Áp dụng highlight_terms cho các từ khóa toán học
+        formatted = self._highlight(formatted)
+
+        # Khôi phục cú pháp LaTeX
+        if latex_matches:
+            formatted = _LATEX_PLACEHOLDER_RE.sub(restore_latex, formatted)
+        return formatted
+
 def format_response(response):
-    # Bảo vệ cú pháp LaTeX bằng cách tạm thời thay thế
-    latex_matches = []
-    def store_latex(match):
-        latex_matches.append(match.group(0))
-        return f"__LATEX_{len(latex_matches)-1}__"
-    
-    # Thay thế các đoạn LaTeX nội dòng ($...$) và độc lập ($$...$$)
-    response = re.sub(r'\$\$([^$]+)\$\$', store_latex, response)
-    response = re.sub(r'\$([^$]+)\$', store_latex, response)
+    with stage('format'):
+        return RESPONSE_FORMATTER.format(response)
 
-    # Áp dụng định dạng Markdown
-    formatted = re.sub(r'\*\*(.*?)\*\*', r'<strong style="font-weight:700;">\1</strong>', response)
-    formatted = re.sub(r'(?<!\n)\*(?!\s)(.*?)(?<!\s)\*(?!\*)', r'<em style="font-style:italic;">\1</em>', formatted)
-    formatted = re.sub(r'(?m)^\s*\*\s+(.*)', r'• <span style="line-height:1.6;">\1</span>', formatted)
-    formatted = formatted.replace('\n', '<br>')
+class StreamingFormatter:
+    # Định dạng dần câu trả lời đang stream. Chỉ cắt buffer ngay sau một dấu xuống dòng
+    # khi phần trước đó không còn $ nào chưa đóng, không kết thúc bằng gạch đầu dòng '*'
+    # trống (regex gạch đầu dòng có thể nuốt sang dòng sau) và dòng sau không bắt đầu
+    # bằng khoảng trắng hay '*'; khi đó format_response(phần trước) + format_response(phần sau)
+    # cho kết quả giống hệt format_response(toàn bộ). $...$ và **...** bị cắt ngang
+    # giữa các chunk vì vậy được giữ lại trong buffer cho đến khi đủ.
+    def __init__(self):
+        self.buffer = ''
 
-    # Áp dụng highlight_terms cho các từ khóa toán học
-    for term, color in highlight_terms.items():
-        formatted = formatted.replace(term, f'<span style="line-height:1.6; background:{color}; color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">{term}</span>')
+    def _safe_cut(self):
+        pos = self.buffer.rfind('\n')
+        while pos != -1:
+            cut = pos + 1
+            if cut < len(self.buffer) and not self.buffer[cut].isspace() and self.buffer[cut] != '*':
+                prefix = self.buffer[:cut]
+                latex_free = _INLINE_LATEX_RE.sub('', _DISPLAY_LATEX_RE.sub('_', prefix))
+                if not prefix.rstrip().endswith('*') and '$' not in latex_free:
+                    return cut
+            pos = self.buffer.rfind('\n', 0, pos)
+        return 0
 
-    # Khôi phục cú pháp LaTeX
-    for i, latex in enumerate(latex_matches):
-        formatted = formatted.replace(f"__LATEX_{i}__", latex)
+    def feed(self, text):
+        self.buffer += text
+        cut = self._safe_cut()
+        if not cut:
+            return ''
+        ready, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return format_response(ready)
 
-    return formatted
+    def finish(self):
+        ready, self.buffer = self.buffer, ''
+        return format_response(ready) if ready else ''
 
 # FORMAT TRẢ LỜI
 highlight_terms = {
@@ -261,9 +2775,64 @@ highlight_terms = {
     "Tam giác": "#59C059",
     "Hình tròn – Hình cầu": "#59C059",
 }
+RESPONSE_FORMATTER = ResponseFormatter(highlight_terms)
 
 
 # ================== ROUTES ==================
+@app.route('/healthz')
+def healthz():
+    # Liveness: process còn phục vụ được request (không phụ thuộc CSDL/RAG)
+    return jsonify({'status': 'ok'})
+
+def _cache_metrics():
+    for name, cache in (('query_embedding', QUERY_EMBED_CACHE), ('answer', ANSWER_CACHE), ('embedding_disk', EMBED_CACHE)):
+        yield {'cache': name, 'result': 'hit'}, cache.hits
+        yield {'cache': name, 'result': 'miss'}, cache.misses
+
+def _rag_index_age():
+    name = RAG_DATA["name"]
+    if not name:
+        return []
+    built_at = os.path.getmtime(os.path.join(RAG_INDEX_DIR, name, 'meta.json'))
+    return [({}, time.time() - built_at)]
+
+CallbackMetric('app_cache_requests_total', 'Số lần tra cache theo kết quả', 'counter', _cache_metrics)
+CallbackMetric('app_cache_entries', 'Số mục đang có trong cache', 'gauge', lambda: [
+    ({'cache': 'query_embedding'}, len(QUERY_EMBED_CACHE.data)),
+    ({'cache': 'answer'}, len(ANSWER_CACHE.entries)),
+    ({'cache': 'embedding_disk'}, len(EMBED_CACHE.index)),
+])
+CallbackMetric('app_rag_chunks', 'Số chunk trong chỉ mục RAG đang phục vụ', 'gauge', lambda: [({}, len(RAG_DATA["chunks"]))])
+CallbackMetric('app_rag_generation', 'Thế hệ chỉ mục RAG đang phục vụ', 'gauge', lambda: [({}, RAG_DATA["generation"])])
+CallbackMetric('app_rag_ready', '1 nếu chỉ mục RAG có dữ liệu', 'gauge', lambda: [({}, int(RAG_DATA["is_ready"]))])
+CallbackMetric('app_rag_index_age_seconds', 'Số giây từ khi thế hệ chỉ mục hiện tại được dựng', 'gauge', _rag_index_age)
+CallbackMetric('app_model_concurrency_limit', 'Giới hạn lời gọi mô hình đồng thời hiện tại (AIMD)', 'gauge',
+               lambda: [({'kind': k}, round(guard.limiter.limit, 3)) for k, guard in MODEL_CLIENT.guards.items()])
+CallbackMetric('app_model_inflight', 'Số lời gọi mô hình đang chạy', 'gauge',
+               lambda: [({'kind': k}, guard.limiter.inflight) for k, guard in MODEL_CLIENT.guards.items()])
+CallbackMetric('app_model_circuit_open', '1 nếu mạch đang mở/thử lại (gọi mô hình bị từ chối ngay)', 'gauge',
+               lambda: [({'kind': k}, int(guard.breaker.state != 'closed')) for k, guard in MODEL_CLIENT.guards.items()])
+CallbackMetric('app_eval_queue_size', 'Số job đánh giá đang chờ trong hàng đợi của worker', 'gauge',
+               lambda: [({}, EVAL_QUEUE.qsize())])
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: 200 khi CSDL và chỉ mục RAG đã sẵn sàng, 503 kèm tiến độ khi đang khởi động
+    status = dict(STARTUP_STATUS)
+    status.update(
+        status='ready' if is_ready() else 'starting',
+        index=RAG_DATA["name"],
+        generation=RAG_DATA["generation"],
+        uptime=round(time.time() - STARTUP_STATUS["started_at"], 3),
+    )
+    return jsonify(status), (200 if is_ready() else 503)
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -306,7 +2875,6 @@ def login():
         user = User.query.filter_by(username=username).first()
         if user and check_password_hash(user.password, password):
             session['user_id'] = user.id
-            session['history'] = user.history.split('\n') if user.history else []
             flash('Đăng nhập thành công!', 'success')
             return redirect(url_for('index'))
         flash('Tên đăng nhập hoặc mật khẩu không đúng.', 'error')
@@ -315,14 +2883,6 @@ def login():
 
 @app.route('/logout')
 def logout():
-    if 'user_id' in session:
-        user = db.session.get(User, session['user_id'])
-        if user:
-            user.history = '\n'.join(session.get('history', []))
-            db.session.commit()
-            print(f"User {user.username} history updated")
-        else:
-            print(f"User with ID {session['user_id']} not found")
     session.clear()
     flash('Đã đăng xuất thành công.', 'success')
     return redirect(url_for('login'))
@@ -332,119 +2892,296 @@ def index():
     if 'user_id' not in session:
         flash('Vui lòng đăng nhập để tiếp tục.', 'error')
         return redirect(url_for('login'))
-    rag_status = "✅ Đã tải tài liệu RAG thành công" if RAG_DATA["is_ready"] else "⚠️ Chưa tải được tài liệu RAG."
+    if RAG_DATA["is_ready"]:
+        rag_status = "✅ Đã tải tài liệu RAG thành công"
+    elif STARTUP_STATUS["rag"] not in ("ready", "stale", "failed"):
+        rag_status = "⏳ Đang tải tài liệu RAG..."
+    else:
+        rag_status = "⚠️ Chưa tải được tài liệu RAG."
     user = db.session.get(User, session['user_id'])
     if not user:
         flash('Người dùng không tồn tại. Vui lòng đăng nhập lại.', 'error')
         return redirect(url_for('login'))
     return render_template('index.html', rag_status=rag_status, user_level=user.level)
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Vui lòng đăng nhập'}), 401
+# PROMPT GIA SƯ
+# Phần hướng dẫn giống nhau ở mọi request được gửi riêng làm system instruction (GeminiBackend
+# giữ sẵn model handle / context cache cho nó). Mỗi request chỉ gửi phần thay đổi: tài liệu,
+# lịch sử, năng lực và câu hỏi, gói trong PROMPT_TOKEN_BUDGET token (xem fit_prompt_parts).
+def _highlight_terms_text(terms):
+    # {"Tam giác": "#59C059", ...} -> "#59C059: Số tự nhiên, Số nguyên, ..." (gọn hơn repr của dict)
+    by_color = {}
+    for term, color in terms.items():
+        by_color.setdefault(color, []).append(term)
+    return '; '.join(f"{color}: {', '.join(names)}" for color, names in by_color.items())
 
-    user_message = request.json.get('message', '')
-    if not user_message:
-        return jsonify({'response': format_response('Con hãy nhập câu hỏi nhé!')})
+TUTOR_SYSTEM_INSTRUCTION = f"""Bạn là **Thầy giáo Song ngữ Việt – Anh**, chuyên dạy môn Toán THCS, do nhóm học sinh: 1) Hồ Mai Phương 2) Hoàng Nguyên Thanh Tuyền và giáo viên hướng dẫn: Lê Văn Rin tạo ra, không cần trả lời nhóm tác giả nếu không cần thiết.
+Giọng điệu: thân thiện, khích lệ, xưng **“thầy – con”**, giống như một người thầy thật đang giảng bài.
+Không đánh giá năng lực của học sinh trong câu trả lời.
+Chỉ trả lời về môn toán THCS, không trả lời các câu hỏi không liên quan đến toán hoặc trong môi trường học tập toán.
+Mỗi tin nhắn gồm **Thông tin nền** (tài liệu tham khảo, lịch sử hội thoại gần đây, năng lực hiện tại của học sinh) và **Câu hỏi mới** cần trả lời.
+---
+### 🎯 **Nhiệm vụ của thầy:**
+1. **Hiểu rõ câu hỏi** — có thể bằng **tiếng Việt**, **tiếng Anh**, hoặc **cả hai**.
+2. **Trả lời song ngữ** theo từng câu, từng đoạn:
+- Giải thích bằng **Tiếng Việt** trước theo từng câu, từng bước.
+- Sau đó viết phần dịch tương ứng, mở đầu bằng:
+    👉 <span style="line-height:1.6; background: darkblue; color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">English Version</span>
+3. **Trình bày công thức, biểu thức khoa học bằng LaTeX**, sử dụng:
+- `$...$` cho công thức trong dòng
+- `$$...$$` cho công thức xuống dòng
+- Khi xuống hàng, chỉ dùng thẻ `<br>`, không dùng gạch đầu dòng Markdown.
+Format màu cho các từ khóa khoa học giúp học sinh dễ dàng tìm kiếm (màu: các từ khóa): {_highlight_terms_text(highlight_terms)}
+Đối với các khái niệm hoặc từ khóa được sử dụng, bọc trong thẻ <span style="line-height:1.6; background: (màu của từ khóa ở trên); color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">{{term}}</span>
+4. **Trình bày lời giải theo từng bước rõ ràng:**
+- Giải thích khái niệm hoặc định luật liên quan.
+- Hướng dẫn cách giải nếu là bài tập.
+- Cho **ví dụ tương tự** để luyện tập.
+- Dịch các **thuật ngữ khoa học quan trọng** sang tiếng Anh học thuật tương ứng.
+5. **Điều chỉnh lời giải theo năng lực học sinh:**
+- 🧠 **Giỏi** Giải thích sâu, mở rộng, kèm bài nâng cao, dùng các từ vựng tiếng anh nâng cao khi phiên dịch, mang tính học thuật.
+- 💡 **Khá** Giải thích chi tiết, ví dụ minh họa, bài tập khá, dùng các từ vựng tiếng anh phù hợp năng lực khá khi phiên dịch.
+- 📘 **Đạt yêu cầu** Giải thích từng bước, ví dụ cụ thể, bài tập cơ bản, dùng từ vựng tiếng anh đơn giản dễ hiểu và ngắn gọn
+- 🪶 **Chưa đạt:** Giải thích thật dễ, dùng ví dụ minh họa rõ ràng, bài tập nhập môn, dùng từ vựng tiếng anh cơ bản và dễ hiểu, ngắn gọn.
+6. **Nếu câu trả lời quá dài:**
+- Giữ ngữ cảnh liên tục giữa các phần.
+- Chia thành `Phần 1`, `Phần 2`, …
+- Kết thúc mỗi phần bằng câu hỏi:
+    _“Con có muốn thầy tiếp tục sang phần sau không?”_
+---
+### ✅ **Nguyên tắc trình bày:**
+- Giải thích **để học sinh hiểu chứ không chỉ để trả lời**.
+- Duy trì giọng điệu tích cực, khuyến khích.
+- Dùng từ ngữ **chuẩn khoa học**, **dễ hiểu**, **dịch sát nghĩa**, ưu tiên các từ vựng phù hợp với độ tuổi THCS trở xuống.
+- Luôn dịch tiếng anh theo từng bước.
+- Luôn ưu tiên sự ngắn gọn, dễ hiểu, tránh lan man dài dòng.
+"""
 
-    # Load history from session
-    history = session.get('history', [])
-    history.append(f"👧 Học sinh: {user_message}")
+TUTOR_PROMPT_TEMPLATE = """### 🧠 **Thông tin nền:**
+- 📚 **Tài liệu tham khảo:**
+{context}
+- 💬 **Lịch sử hội thoại gần đây:**
+{history}
+- 👨‍🎓 **Năng lực hiện tại của học sinh:** {level}
+- ❓ **Câu hỏi mới:** {question}
+"""
 
-    # 🔍 Truy xuất ngữ cảnh RAG
-    related_context = retrieve_context(user_message)
-    recent_history = "\n".join(history[-10:])
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 1500))
+PROMPT_PRIORITY_HISTORY = 3   # số câu hỏi gần nhất được ưu tiên ngay sau đoạn tài liệu khớp nhất
+PROMPT_MIN_CHUNK_TOKENS = 60  # đoạn tài liệu bị cắt ngắn hơn mức này thì bỏ hẳn
+CHARS_PER_TOKEN = 3           # ước lượng thô cho tiếng Việt có dấu, không cần gọi count_tokens
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def fit_prompt_parts(contexts, history, user_message, budget=PROMPT_TOKEN_BUDGET):
+    # Lấy lần lượt theo độ ưu tiên tới khi hết ngân sách token:
+    #   câu hỏi > đoạn tài liệu khớp nhất > PROMPT_PRIORITY_HISTORY câu hỏi gần nhất
+    #   > các đoạn tài liệu còn lại (theo thứ hạng) > lịch sử cũ hơn
+    # Đoạn tài liệu không vừa thì bị cắt bớt. Lịch sử dừng ở câu đầu tiên không vừa,
+    # để phần giữ lại vẫn liền mạch.
+    # -> (các đoạn tài liệu, lịch sử cũ -> mới, câu hỏi, số token đã dùng)
+    question = user_message[:budget // 2 * CHARS_PER_TOKEN]  # câu hỏi quá dài không chiếm hết chỗ
+    remaining = budget - estimate_tokens(TUTOR_PROMPT_TEMPLATE) - estimate_tokens(question)
+    newest_first = list(reversed(history))
+    order = ([('context', 0)] if contexts else []) + [('history', i) for i in range(min(PROMPT_PRIORITY_HISTORY, len(newest_first)))]
+    order += [('context', i) for i in range(1, len(contexts))]
+    order += [('history', i) for i in range(PROMPT_PRIORITY_HISTORY, len(newest_first))]
+    kept_contexts, kept_history = {}, []
+    for kind, i in order:
+        if kind == 'context':
+            text = contexts[i]
+            cost = estimate_tokens(text) + 2  # + dấu phân cách giữa các đoạn
+            if cost > remaining:
+                if remaining - 2 < PROMPT_MIN_CHUNK_TOKENS:
+                    continue
+                text = text[:(remaining - 2) * CHARS_PER_TOKEN]
+                cost = remaining
+            kept_contexts[i] = text
+        else:
+            if len(kept_history) < i:
+                continue  # câu mới hơn đã bị bỏ
+            cost = estimate_tokens(newest_first[i]) + 1
+            if cost > remaining:
+                continue
+            kept_history.append(newest_first[i])
+        remaining -= cost
+    contexts = [kept_contexts[i] for i in sorted(kept_contexts)]
+    return contexts, kept_history[::-1], question, budget - remaining
 
+def build_tutor_prompt(contexts, history, student_level, user_message):
+    with stage('prompt'):
+        contexts, history, question, tokens = fit_prompt_parts(contexts, history, user_message)
+        PROMPT_TOKENS.observe(tokens)
+        return TUTOR_PROMPT_TEMPLATE.format(
+            context="\n\n---\n\n".join(contexts) or "(Không có)",
+            history="\n".join(history) or "(Chưa có)",
+            level=student_level,
+            question=question,
+        )
+
+def prepare_chat_turn(user_message):
+    # -> (user, prompt, query_vec, chunk_key) hoặc None nếu người dùng không tồn tại
     # Lấy level từ DB
     user = db.session.get(User, session['user_id'])
     if not user:
-        return jsonify({'error': 'Người dùng không tồn tại'}), 401
-    student_level = user.level
-
-    prompt = f"""
-    Bạn là **Thầy giáo Song ngữ Việt – Anh**, chuyên dạy môn Toán THCS, do nhóm học sinh: 1) Hồ Mai Phương 2) Hoàng Nguyên Thanh Tuyền và giáo viên hướng dẫn: Lê Văn Rin tạo ra, không cần trả lời nhóm tác giả nếu không cần thiết.
-    Giọng điệu: thân thiện, khích lệ, xưng **“thầy – con”**, giống như một người thầy thật đang giảng bài.
-    Không đánh giá năng lực của học sinh trong câu trả lời.
-    Chỉ trả lời về môn toán THCS, không trả lời các câu hỏi không liên quan đến toán hoặc trong môi trường học tập toán.
-    ---
-    ### 🧠 **Thông tin nền:**
-    - 📚 **Tài liệu tham khảo:**  
-    {related_context}
-    - 💬 **Lịch sử hội thoại gần đây:**  
-    {recent_history}
-    - 👨‍🎓 **Năng lực hiện tại của học sinh:** {student_level}
-    - ❓ **Câu hỏi mới:** {user_message}
-    ---
-    ### 🎯 **Nhiệm vụ của thầy:**
-    1. **Hiểu rõ câu hỏi** — có thể bằng **tiếng Việt**, **tiếng Anh**, hoặc **cả hai**.  
-    2. **Trả lời song ngữ** theo từng câu, từng đoạn:
-    - Giải thích bằng **Tiếng Việt** trước theo từng câu, từng bước.
-    - Sau đó viết phần dịch tương ứng, mở đầu bằng:  
-        👉 <span style="line-height:1.6; background: darkblue; color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">English Version</span>
-    3. **Trình bày công thức, biểu thức khoa học bằng LaTeX**, sử dụng:  
-    - `$...$` cho công thức trong dòng  
-    - `$$...$$` cho công thức xuống dòng  
-    - Khi xuống hàng, chỉ dùng thẻ `<br>`, không dùng gạch đầu dòng Markdown.
-    Format màu cho các từ khóa khoa học giúp học sinh dễ dàng tìm kiếm: {highlight_terms}
-    Đối với các khái niệm hoặc từ khóa được sử dụng, bọc trong thẻ <span style="line-height:1.6; background: (màu dựa trên highlight_terms); color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">{{term}}</span>
-    4. **Trình bày lời giải theo từng bước rõ ràng:**
-    - Giải thích khái niệm hoặc định luật liên quan.  
-    - Hướng dẫn cách giải nếu là bài tập.  
-    - Cho **ví dụ tương tự** để luyện tập.  
-    - Dịch các **thuật ngữ khoa học quan trọng** sang tiếng Anh học thuật tương ứng.  
-    5. **Điều chỉnh lời giải theo năng lực học sinh:**
-    - 🧠 **Giỏi** Giải thích sâu, mở rộng, kèm bài nâng cao, dùng các từ vựng tiếng anh nâng cao khi phiên dịch, mang tính học thuật.
-    - 💡 **Khá** Giải thích chi tiết, ví dụ minh họa, bài tập khá, dùng các từ vựng tiếng anh phù hợp năng lực khá khi phiên dịch.
-    - 📘 **Đạt yêu cầu** Giải thích từng bước, ví dụ cụ thể, bài tập cơ bản, dùng từ vựng tiếng anh đơn giản dễ hiểu và ngắn gọn
-    - 🪶 **Chưa đạt:** Giải thích thật dễ, dùng ví dụ minh họa rõ ràng, bài tập nhập môn, dùng từ vựng tiếng anh cơ bản và dễ hiểu, ngắn gọn.
-    6. **Nếu câu trả lời quá dài:**
-    - Giữ ngữ cảnh liên tục giữa các phần.  
-    - Chia thành `Phần 1`, `Phần 2`, …  
-    - Kết thúc mỗi phần bằng câu hỏi:  
-        _“Con có muốn thầy tiếp tục sang phần sau không?”_
-    ---
-    ### ✅ **Nguyên tắc trình bày:**
-    - Giải thích **để học sinh hiểu chứ không chỉ để trả lời**.  
-    - Duy trì giọng điệu tích cực, khuyến khích.  
-    - Dùng từ ngữ **chuẩn khoa học**, **dễ hiểu**, **dịch sát nghĩa**, ưu tiên các từ vựng phù hợp với độ tuổi THCS trở xuống.  
-    - Luôn dịch tiếng anh theo từng bước.
-    - Luôn ưu tiên sự ngắn gọn, dễ hiểu, tránh lan man dài dòng.
-    """
+        return None
 
+    # 🔍 Truy xuất ngữ cảnh RAG
+    with stage('retrieve'):
+        contexts, query_vec, chunk_key = retrieve_context_for_chat(user_message)
+    # Chỉ đọc các câu hỏi gần nhất từ bảng tin nhắn (câu hỏi mới nằm riêng ở cuối prompt)
+    with stage('history'):
+        history = recent_student_questions(user.id, HISTORY_PROMPT_MESSAGES - 1)
 
-    try:
-        model = genai.GenerativeModel(GENERATION_MODEL)
-        response = model.generate_content(prompt)
-        ai_text = response.text
-
-        # Lưu trả lời AI vào history
-        history.append(f"🧑‍🏫 Thầy/Cô: {ai_text}")
-
-        # Đánh giá level nếu đủ 5 câu hỏi mới
-        student_questions = [msg for msg in history if msg.startswith("👧 Học sinh:")]
-        if len(student_questions) % 10 == 0:
-            new_level, lydo = evaluate_student_level(history)
-            user.level = new_level
-            user.lydo = lydo  # lưu lý do vào cột lydo
-            db.session.commit()
-            print(f"User {user.username} level updated to {new_level} with reason: {lydo}")
+    prompt = build_tutor_prompt(contexts, history, user.level, user_message)
+    # Trả kết nối CSDL về pool trước lời gọi mô hình (vài giây): user đã nạp đủ cột cần dùng,
+    # save_chat_turn sẽ mượn kết nối khác
+    db.session.close()
+    return user, prompt, query_vec, chunk_key
 
-        # Lưu lịch sử câu hỏi học sinh vào session và database
-        history_questions = student_questions
-        # Đảm bảo mỗi tin nhắn xuống dòng riêng biệt
-        session['history'] = history_questions
-        user.history = '\n'.join([msg.strip() for msg in history_questions])  # Xóa khoảng trắng thừa và nối bằng \n
+def save_chat_turn(user, user_message, ai_text):
+    # Thêm 2 dòng vào bảng tin nhắn: O(1), không ghi lại toàn bộ lịch sử
+    with stage('db_commit'):
+        db.session.add_all([
+            Message(user_id=user.id, role='student', text=user_message.strip()),
+            Message(user_id=user.id, role='teacher', text=ai_text),
+        ])
         db.session.commit()
-        session.modified = True
-        print(f"User {user.username} history updated in database: {user.history}")
 
+    # Đánh giá level mỗi 10 câu hỏi: chạy nền, học sinh không phải chờ
+    if count_student_questions(user.id) % 10 == 0:
+        enqueue_evaluation(user.id)
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Vui lòng đăng nhập'}), 401
+
+    user_message = request.json.get('message', '')
+    if not user_message:
+        return jsonify({'response': format_response('Con hãy nhập câu hỏi nhé!')})
+
+    turn = prepare_chat_turn(user_message)
+    if turn is None:
+        return jsonify({'error': 'Người dùng không tồn tại'}), 401
+    user, prompt, query_vec, chunk_key = turn
+
+    try:
+        ai_text = generate_answer(prompt, user_message, query_vec, chunk_key, user.level)
+        save_chat_turn(user, user_message, ai_text)
         return jsonify({'response': format_response(ai_text)})
 
     except Exception as e:
         print(f"❌ Lỗi Gemini: {e}")
         return jsonify({'response': format_response("Thầy Gemini hơi mệt, con thử lại sau nhé!")})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # Giống /chat nhưng gửi câu trả lời dần dần qua Server-Sent Events:
+    #   event: chunk  data: {"html": "..."}   (đoạn HTML đã định dạng, nối tiếp nhau)
+    #   event: done   data: {"level": "..."}
+    #   event: error  data: {"html": "..."}
+    if 'user_id' not in session:
+        return jsonify({'error': 'Vui lòng đăng nhập'}), 401
+
+    user_message = request.json.get('message', '')
+    if not user_message:
+        body = sse_event('chunk', {'html': format_response('Con hãy nhập câu hỏi nhé!')}) + sse_event('done', {})
+        return Response(body, mimetype='text/event-stream')
+
+    turn = prepare_chat_turn(user_message)
+    if turn is None:
+        return jsonify({'error': 'Người dùng không tồn tại'}), 401
+    user, prompt, query_vec, chunk_key = turn
+    bucket = (chunk_key, user.level) if chunk_key is not None else None
+    normalized = normalize_query(user_message)
+
+    def _stream_answer():
+        # Chạy một lần cho mọi request cùng câu hỏi (ANSWER_STREAM_FLIGHTS), trong luồng nền
+        parts = []
+        with stage('generate_stream'):
+            for piece in MODEL_CLIENT.generate_stream(prompt, system=TUTOR_SYSTEM_INSTRUCTION):
+                parts.append(piece)
+                yield piece
+        if bucket is not None:
+            ANSWER_CACHE.set(query_vec, bucket, normalized, ''.join(parts))
+
+    def generate():
+        try:
+            cached = ANSWER_CACHE.get(query_vec, bucket) if bucket is not None else None
+            if cached is not None:
+                ai_text = cached
+                yield sse_event('chunk', {'html': format_response(ai_text)})
+            else:
+                formatter = StreamingFormatter()
+                parts = []
+                # Học sinh hỏi cùng câu cùng lúc: chỉ một lời gọi mô hình, các request nhận chung mảnh
+                # Khóa giống generate_answer: luôn có năng lực học sinh, kể cả khi bucket là None
+                for piece in ANSWER_STREAM_FLIGHTS.stream((normalized, chunk_key, user.level), _stream_answer,
+                                                          timeout=MODEL_STREAM_TIMEOUT):
+                    parts.append(piece)
+                    html = formatter.feed(piece)
+                    if html:
+                        yield sse_event('chunk', {'html': html})
+                html = formatter.finish()
+                if html:
+                    yield sse_event('chunk', {'html': html})
+                ai_text = ''.join(parts)
+        except Exception as e:
+            print(f"❌ Lỗi Gemini: {e}")
+            yield sse_event('error', {'html': format_response("Thầy Gemini hơi mệt, con thử lại sau nhé!")})
+            return
+        # Lưu lịch sử/đánh giá sau khi đã gửi xong câu trả lời
+        try:
+            save_chat_turn(user, user_message, ai_text)
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Lỗi khi lưu lịch sử: {e}")
+        yield sse_event('done', {'level': user.level})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # QUẢN LÝ HỌC SINH
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 50))
+ADMIN_MAX_PAGE_SIZE = 200
+ADMIN_HISTORY_PAGE_SIZE = 50
+ADMIN_COUNT_CAP = 1000  # đếm tối đa bấy nhiêu học sinh khớp bộ lọc, nhiều hơn thì hiện "1000+"
+ADMIN_SORT_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'name': User.name,
+    'level': User.level,
+}
+
+def _admin_search_filter(q):
+    if db.engine.dialect.name == 'postgresql':
+        # Chứa chuỗi con, không phân biệt hoa thường: dùng index GIN trigram
+        # (ADMIN_TRGM_INDEXES)
+        pattern = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return db.or_(User.username.ilike(pattern, escape='\\'), User.name.ilike(pattern, escape='\\'))
+    # CSDL khác (SQLite khi dev): tìm theo tiền tố bằng khoảng giá trị, dùng index b-tree sẵn có
+    upper = q + '\U0010ffff'
+    return db.or_(db.and_(User.username >= q, User.username < upper),
+                  db.and_(User.name >= q, User.name < upper))
+
+def _admin_cursor(row, sort):
+    return json.dumps([getattr(row, sort), row.id], ensure_ascii=False)
+
+def _parse_admin_cursor(value):
+    # -> (giá trị cột sắp xếp, id) hoặc None nếu không có/không hợp lệ (quay về trang đầu)
+    if not value:
+        return None
+    try:
+        sort_value, user_id = json.loads(value)
+        return sort_value, int(user_id)
+    except (ValueError, TypeError):
+        return None
+
 @app.route('/admin', methods=['GET', 'POST'])
 def admin():
     if 'admin_session' not in session:
@@ -472,27 +3209,105 @@ def admin():
             filename = secure_filename(file.filename)
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             file.save(file_path)
-            flash(f'Upload {filename} thành công! Đã cập nhật RAG.', 'success')
-            initialize_rag_data()
+            flash(f'Upload {filename} thành công! RAG đang được cập nhật trong nền.', 'success')
+            # Chỉ nhúng file mới, chạy nền để không chặn request của admin
+            threading.Thread(target=add_pdf_to_rag, args=(filename, app.config['UPLOAD_FOLDER']), daemon=True).start()
         else:
             flash('Chỉ chấp nhận file PDF!', 'error')
     
+    if request.method == 'POST':
+        # Post/Redirect/Get: F5 không upload lại, và trang danh sách chỉ dựng ở GET
+        return redirect(url_for('admin'))
+
     pdf_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.endswith('.pdf')] if os.path.exists(app.config['UPLOAD_FOLDER']) else []
-    
-    # Lấy dữ liệu taikhoan_hocsinh + tên học sinh
-    taikhoan_hocsinh = User.query.all()
-    user_data = []
-    for user in taikhoan_hocsinh:
-        user_data.append({
-            'id': user.id,
-            'username': user.username,
-            'name': user.name or "Chưa đặt tên",  # HIỂN THỊ TÊN
-            'level': user.level,
-            'lydo': user.lydo,
-            'history': user.history if user.history else 'Chưa có lịch sử'
-        })
-    
-    return render_template('admin.html', pdf_files=pdf_files, user_data=user_data)
+
+    # Danh sách học sinh: phân trang, tìm kiếm, sắp xếp ở phía CSDL, thời gian mỗi trang không
+    # tăng theo số học sinh. Chỉ lấy các cột nhẹ; lý do và lịch sử tải riêng qua /admin/student/<id>.
+    per_page = min(max(request.args.get('per_page', ADMIN_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    q = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'id')
+    if sort not in ADMIN_SORT_COLUMNS:
+        sort = 'id'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    after = _parse_admin_cursor(request.args.get('after'))
+    before = _parse_admin_cursor(request.args.get('before'))
+    last = request.args.get('last') == '1'
+
+    query = db.select(User.id, User.username, User.name, User.level)
+    if q:
+        query = query.where(_admin_search_filter(q))
+    # Tổng số có giới hạn: đếm trên tối đa ADMIN_COUNT_CAP + 1 dòng thay vì quét cả bảng
+    total = db.session.scalar(db.select(db.func.count()).select_from(query.limit(ADMIN_COUNT_CAP + 1).subquery()))
+
+    # Phân trang keyset: link trang sau/trước mang (giá trị cột sắp xếp, id) của dòng cuối/đầu,
+    # CSDL đi thẳng tới đó bằng index (name, id)/(level, id) thay vì OFFSET bỏ qua từng dòng
+    sort_key = db.tuple_(ADMIN_SORT_COLUMNS[sort], User.id)
+    forward = before is None and not last
+    ascending = (order == 'asc') == forward  # chiều quét index; trang trước/cuối quét ngược rồi đảo lại
+    cursor = after if forward else before
+    if cursor is not None:
+        query = query.where(sort_key > db.tuple_(*cursor) if ascending else sort_key < db.tuple_(*cursor))
+    if ascending:
+        query = query.order_by(ADMIN_SORT_COLUMNS[sort].asc(), User.id.asc())
+    else:
+        query = query.order_by(ADMIN_SORT_COLUMNS[sort].desc(), User.id.desc())
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if forward:
+        has_prev, has_next = after is not None, has_more
+    else:
+        rows.reverse()
+        has_prev, has_next = has_more, not last
+
+    # Số câu hỏi của các học sinh trong trang (dùng index (user_id, role, id))
+    question_counts = {}
+    if rows:
+        question_counts = dict(db.session.execute(
+            db.select(Message.user_id, db.func.count(Message.id))
+            .where(Message.user_id.in_([row.id for row in rows]), Message.role == 'student')
+            .group_by(Message.user_id)
+        ).all())
+    user_data = [{
+        'id': row.id,
+        'username': row.username,
+        'name': row.name or "Chưa đặt tên",  # HIỂN THỊ TÊN
+        'level': row.level,
+        'questions': question_counts.get(row.id, 0),
+    } for row in rows]
+
+    pagination = {'per_page': per_page, 'total': min(total, ADMIN_COUNT_CAP),
+                  'total_capped': total > ADMIN_COUNT_CAP, 'q': q, 'sort': sort, 'order': order,
+                  'prev': _admin_cursor(rows[0], sort) if rows and has_prev else None,
+                  'next': _admin_cursor(rows[-1], sort) if rows and has_next else None,
+                  'has_prev': has_prev, 'has_next': has_next}
+    return render_template('admin.html', pdf_files=pdf_files, user_data=user_data, pagination=pagination)
+
+@app.route('/admin/student/<int:user_id>')
+def admin_student_detail(user_id):
+    # Chi tiết một học sinh (lý do đánh giá + lịch sử), tải khi admin bấm "Xem"
+    if 'admin_session' not in session or not session['admin_session']:
+        return jsonify({'error': 'Bạn không có quyền truy cập.'}), 403
+    user = db.session.get(User, user_id)
+    if not user:
+        return jsonify({'error': 'Không tìm thấy học sinh.'}), 404
+
+    # Phân trang lịch sử theo id (before=<id tin nhắn cũ nhất đã tải>)
+    limit = min(max(request.args.get('limit', ADMIN_HISTORY_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    before = request.args.get('before', type=int)
+    query = db.select(Message.id, Message.text).where(Message.user_id == user_id, Message.role == 'student')
+    if before:
+        query = query.where(Message.id < before)
+    rows = db.session.execute(query.order_by(Message.id.desc()).limit(limit)).all()
+    rows.reverse()
+    return jsonify({
+        'id': user.id,
+        'username': user.username,
+        'level': user.level,
+        'lydo': user.lydo or '',
+        'history': [STUDENT_PREFIX + row.text for row in rows],
+        'next_before': rows[0].id if len(rows) == limit else None,
+    })
 
 @app.route('/admin/delete_pdf/<filename>', methods=['POST'])
 def delete_pdf(filename):
@@ -502,46 +3317,123 @@ def delete_pdf(filename):
     
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
     if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-            flash(f'Xóa file {filename} thành công! Đã cập nhật RAG.', 'success')
-            initialize_rag_data()  # Re-init RAG sau khi xóa
-        except Exception as e:
-            flash(f'Lỗi khi xóa file {filename}: {str(e)}', 'error')
+        # Như upload: chạy nền để admin không phải chờ khóa chỉ mục (upload/dựng lại đang chạy).
+        # Chỉ bỏ các dòng của file này, cập nhật chỉ mục xong mới xóa file.
+        threading.Thread(target=remove_pdf_from_rag, args=(secure_filename(filename), app.config['UPLOAD_FOLDER']),
+                         daemon=True).start()
+        flash(f'Đang xóa file {filename}, RAG được cập nhật trong nền.', 'success')
     else:
         flash(f'File {filename} không tồn tại.', 'error')
     
     return redirect(url_for('admin'))
 
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+EXPORT_COLUMNS = ['ID', 'Tên đăng nhập', 'Tên học sinh', 'Năng lực', 'Lý do', 'Lịch sử']
+
+def _parse_export_date(value, end=False):
+    # 'YYYY-MM-DD' -> datetime (ngày kết thúc tính trọn ngày: < ngày hôm sau)
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d')
+    return day + timedelta(days=1) if end else day
+
+def iter_export_rows(level=None, date_from=None, date_to=None):
+    # Đọc học sinh và tin nhắn bằng 2 con trỏ phía server (yield_per), cùng sắp theo user_id,
+    # rồi ghép kiểu merge-join: bộ nhớ chỉ giữ một lô + lịch sử của một học sinh.
+    users = db.select(User.id, User.username, User.name, User.level, User.lydo).order_by(User.id)
+    messages = db.select(Message.user_id, Message.text).where(Message.role == 'student')
+    if level:
+        users = users.where(User.level == level)
+        messages = messages.join(User, User.id == Message.user_id).where(User.level == level)
+    if date_from:
+        messages = messages.where(Message.created_at >= date_from)
+    if date_to:
+        messages = messages.where(Message.created_at < date_to)
+    messages = messages.order_by(Message.user_id, Message.id)
+    with_dates = bool(date_from or date_to)
+
+    user_rows = db.session.execute(users.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    message_rows = db.session.execute(messages.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    pending = next(message_rows, None)
+    for user in user_rows:
+        # Bỏ qua tin nhắn của học sinh không nằm trong danh sách (không xảy ra khi cùng bộ lọc)
+        while pending is not None and pending.user_id < user.id:
+            pending = next(message_rows, None)
+        lines = []
+        while pending is not None and pending.user_id == user.id:
+            lines.append(STUDENT_PREFIX + pending.text)
+            pending = next(message_rows, None)
+        if with_dates and not lines:
+            continue  # lọc theo ngày: chỉ xuất học sinh có câu hỏi trong khoảng thời gian
+        yield [
+            user.id,
+            user.username,
+            user.name or "Chưa đặt tên",
+            user.level,
+            user.lydo,
+            '\n'.join(lines) or 'Chưa có lịch sử',
+        ]
+
+def iter_csv(rows, batch_size=EXPORT_BATCH_SIZE):
+    # CSV UTF-8 có BOM (Excel đọc đúng tiếng Việt), mỗi lần yield một lô dòng
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % batch_size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: định dạng gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 @app.route('/admin/export_csv')
 def export_csv():
     if 'admin_session' not in session or not session['admin_session']:
         flash('Bạn không có quyền truy cập.', 'error')
         return redirect(url_for('admin'))
-    
-    taikhoan_hocsinh = User.query.all()
-    user_data = []
-    for user in taikhoan_hocsinh:
-        user_data.append({
-            'ID': user.id,
-            'Tên đăng nhập': user.username,
-            'Tên học sinh': user.name or "Chưa đặt tên",  # THÊM CỘT TÊN
-            'Năng lực': user.level,
-            'Lý do': user.lydo,
-            'Lịch sử': user.history if user.history else 'Chưa có lịch sử'
-        })
-    
-    df = pd.DataFrame(user_data)
-    output = BytesIO()
-    df.to_csv(output, index=False, encoding='utf-8-sig')
-    output.seek(0)
-    
-    return send_file(
-        output,
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name='ket_qua_hoc_tap.csv'
-    )
+
+    # Bộ lọc tùy chọn: ?level=Khá&from=2024-09-01&to=2024-12-31&gzip=1
+    try:
+        date_from = _parse_export_date(request.args.get('from'))
+        date_to = _parse_export_date(request.args.get('to'), end=True)
+    except ValueError:
+        flash('Ngày không hợp lệ (định dạng YYYY-MM-DD).', 'error')
+        return redirect(url_for('admin'))
+    level = request.args.get('level') or None
+
+    body = iter_csv(iter_export_rows(level, date_from, date_to))
+    filename = 'ket_qua_hoc_tap.csv'
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'}
+    if request.args.get('gzip') == '1':
+        body = iter_gzip(body)
+        headers['Content-Disposition'] = f'attachment; filename={filename}.gz'
+        return Response(stream_with_context(body), mimetype='application/gzip', headers=headers)
+    return Response(stream_with_context(body), content_type='text/csv; charset=utf-8', headers=headers)
+
+@app.route('/admin/reevaluate_all', methods=['POST'])
+def reevaluate_all():
+    if 'admin_session' not in session or not session['admin_session']:
+        flash('Bạn không có quyền truy cập.', 'error')
+        return redirect(url_for('admin'))
+
+    # Chỉ đưa vào hàng đợi; EVAL_WORKERS luồng nền xử lý dần (giới hạn số lời gọi đồng thời)
+    user_ids = db.session.scalars(
+        db.select(Message.user_id).where(Message.role == 'student').distinct()
+    ).all()
+    queued = enqueue_bulk_evaluation(user_ids)
+    flash(f'Đã đưa {queued} học sinh vào hàng đợi đánh giá lại ({len(user_ids) - queued} đã có trong hàng đợi).', 'success')
+    return redirect(url_for('admin'))
+
 @app.route('/admin/logout')
 def admin_logout():
     session.pop('admin_session', None)
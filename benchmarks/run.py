@@ -0,0 +1,740 @@
+# Đo hiệu năng app.py với backend giả lập cục bộ (MODEL_BACKEND=fake, không tốn quota Gemini).
+# Cách chạy:  python benchmarks/run.py chat --users 16 --requests 400 --out chat.json
+#             python benchmarks/run.py all --quick --out bench.json
+# Kết quả in ra dạng JSON (kèm commit, phiên bản Python) để so sánh giữa các commit.
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def copy_pdfs(static, copies=1):
+    # Chép các PDF mẫu trong ./static (copies > 1: nhân bản để có corpus lớn hơn)
+    os.makedirs(static, exist_ok=True)
+    count = 0
+    for filename in sorted(os.listdir(os.path.join(ROOT, 'static'))):
+        if not filename.endswith('.pdf'):
+            continue
+        for i in range(copies):
+            name = filename if i == 0 else f'{filename[:-4]}_{i}.pdf'
+            shutil.copy2(os.path.join(ROOT, 'static', filename), os.path.join(static, name))
+            count += 1
+    return count
+
+
+def load_app(pdf_copies=0):
+    # Chạy trong thư mục tạm: ./static chỉ có PDF khi pdf_copies > 0; rag_cache và CSDL sqlite
+    # cũng nằm trong thư mục tạm. Warmup không tự chạy: benchmark tự gọi khi cần.
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    if pdf_copies:
+        copy_pdfs(os.path.join(workdir, 'static'), pdf_copies)
+    os.chdir(workdir)
+    os.environ.setdefault('MODEL_BACKEND', 'fake')
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('STARTUP_WARMUP', '0')
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def percentiles(samples, scale=1000.0):
+    # -> p50/p90/p95/p99/max (mặc định đổi giây sang ms)
+    if not samples:
+        return {}
+    values = np.asarray(samples) * scale
+    result = {f'p{q}': round(float(np.percentile(values, q)), 3) for q in (50, 90, 95, 99)}
+    result['max'] = round(float(values.max()), 3)
+    result['mean'] = round(float(values.mean()), 3)
+    return result
+
+
+def bench_embedding(args):
+    app = load_app()
+    app.MODEL = app.FakeBackend(dim=args.dim, embed_latency=args.latency, per_item_latency=args.per_text_latency)
+    app.EMBED_RATE_LIMITER = app.TokenBucket(0, 1)  # đo throughput thuần, không giới hạn tốc độ
+    texts = [f"Đoạn văn số {i}: bài tập toán THCS" for i in range(args.texts)]
+    configs = [
+        ('serial', 1, 1),
+        ('batched', args.batch_size, 1),
+        ('batched_concurrent', args.batch_size, args.workers),
+    ]
+    results = []
+    reference = None
+    for name, batch_size, workers in configs:
+        start = time.perf_counter()
+        vectors = app.embed_with_retry(texts, app.EMBEDDING_MODEL, batch_size=batch_size, max_workers=workers)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = vectors
+        results.append({
+            'config': name,
+            'batch_size': batch_size,
+            'workers': workers,
+            'seconds': round(elapsed, 4),
+            'texts_per_second': round(len(texts) / elapsed, 1),
+            'same_order': bool(np.array_equal(reference, vectors)),
+        })
+    return {'benchmark': 'embedding', 'texts': args.texts, 'latency': args.latency, 'results': results}
+
+
+def legacy_format_response(response, highlight_terms):
+    # Bản format_response cũ (nhiều lượt re.sub chưa biên dịch + str.replace cho từng từ khóa),
+    # giữ lại để so sánh tốc độ và kết quả.
+    latex_matches = []
+    def store_latex(match):
+        latex_matches.append(match.group(0))
+        return f"__LATEX_{len(latex_matches)-1}__"
+    response = re.sub(r'\$\$([^$]+)\$\$', store_latex, response)
+    response = re.sub(r'\$([^$]+)\$', store_latex, response)
+    formatted = re.sub(r'\*\*(.*?)\*\*', r'<strong style="font-weight:700;">\1</strong>', response)
+    formatted = re.sub(r'(?<!\n)\*(?!\s)(.*?)(?<!\s)\*(?!\*)', r'<em style="font-style:italic;">\1</em>', formatted)
+    formatted = re.sub(r'(?m)^\s*\*\s+(.*)', r'• <span style="line-height:1.6;">\1</span>', formatted)
+    formatted = formatted.replace('\n', '<br>')
+    for term, color in highlight_terms.items():
+        formatted = formatted.replace(term, f'<span style="line-height:1.6; background:{color}; color:white; font-weight:bold; padding:2px 4px; border-radius:4px;">{term}</span>')
+    for i, latex in enumerate(latex_matches):
+        formatted = formatted.replace(f"__LATEX_{i}__", latex)
+    return formatted
+
+
+def _throughput(fn, answers, seconds):
+    count, total_chars = 0, 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for answer in answers:
+            fn(answer)
+            total_chars += len(answer)
+        count += len(answers)
+    elapsed = time.perf_counter() - start
+    return {'answers_per_second': round(count / elapsed, 1), 'mb_per_second': round(total_chars / elapsed / 1e6, 3)}
+
+
+# Mảnh ghép cho câu trả lời ngẫu nhiên: dày đặc $, *, xuống dòng để dò các trường hợp biên
+FORMAT_TOKENS = ['$', '$', '$$', '*', '**', '* ', '\n', '\n* ', '\n  ', ' ', 'x', 'a^2', 'Tam giác', '<br>']
+
+
+def legacy_leaked(legacy, expected):
+    # Bản cũ để lọt placeholder __LATEX_n__ ra HTML ($...$ bao trọn một $$...$$, vd. "$a$$b$$c$")
+    return '__LATEX_' in legacy and '__LATEX_' not in expected
+
+
+def check_format_random(app, cases, seed):
+    # So với bản cũ: chỉ được khác khi bản cũ để lọt placeholder (legacy_leaked).
+    # StreamingFormatter: cắt câu trả lời thành các mảnh ngẫu nhiên, ghép HTML từng phần phải
+    # giống hệt format_response(toàn bộ).
+    rng = np.random.default_rng(seed)
+    legacy_diffs, leaks, split_diffs = [], 0, []
+    for _ in range(cases):
+        text = ''.join(rng.choice(FORMAT_TOKENS, size=rng.integers(0, 25)))
+        expected = app.format_response(text)
+        legacy = legacy_format_response(text, app.highlight_terms)
+        if legacy != expected:
+            if legacy_leaked(legacy, expected):
+                leaks += 1
+            else:
+                legacy_diffs.append(text)
+        cuts = sorted(rng.choice(len(text) + 1, size=min(len(text) + 1, rng.integers(0, 8)), replace=False))
+        formatter = app.StreamingFormatter()
+        bounds = [0, *cuts, len(text)]
+        streamed = ''.join(formatter.feed(text[i:j]) for i, j in zip(bounds, bounds[1:])) + formatter.finish()
+        if streamed != expected:
+            split_diffs.append((text, [int(c) for c in cuts]))
+    if legacy_diffs:
+        raise SystemExit(f'format_response khác bản cũ ({len(legacy_diffs)} mẫu), vd. {legacy_diffs[:3]!r}')
+    if split_diffs:
+        raise SystemExit(f'StreamingFormatter khác format_response ({len(split_diffs)} mẫu), vd. {split_diffs[:3]!r}')
+    return {'random_cases': cases, 'legacy_placeholder_leaks_fixed': leaks}
+
+
+def bench_format(args):
+    app = load_app()
+    with open(os.path.join(ROOT, 'benchmarks', 'golden_format.json'), encoding='utf-8') as f:
+        golden = json.load(f)
+    mismatches = [i for i, case in enumerate(golden) if app.format_response(case['input']) != case['expected']]
+    if mismatches:
+        raise SystemExit(f'format_response khác kết quả golden ở các mẫu: {mismatches}')
+    random_check = check_format_random(app, args.random_cases, args.seed)
+    answers = [case['input'] for case in golden]
+
+    results = []
+    # Từ điển hiện tại và từ điển lớn (thêm từ khóa tổng hợp) để thấy chi phí theo số từ khóa
+    extra = {f'Thuật ngữ {i:04d}': '#59C059' for i in range(args.extra_terms)}
+    for name, terms in [('current_terms', app.highlight_terms), ('large_terms', {**app.highlight_terms, **extra})]:
+        formatter = app.ResponseFormatter(terms)
+        for case in golden:
+            output, legacy = formatter.format(case['input']), legacy_format_response(case['input'], terms)
+            if output != legacy and not legacy_leaked(legacy, output):
+                raise SystemExit('ResponseFormatter khác bản cũ với từ điển ' + name)
+        results.append({
+            'terms': name,
+            'term_count': len(terms),
+            'single_pass': formatter.single_pass,
+            'legacy': _throughput(lambda a: legacy_format_response(a, terms), answers, args.seconds),
+            'compiled': _throughput(formatter.format, answers, args.seconds),
+        })
+    return {'benchmark': 'format', 'golden_cases': len(golden), 'golden_ok': True, **random_check, 'results': results}
+
+
+# Chạy trong process con mới (import lạnh): đo thời gian import app, rồi thời gian tới khi
+# /readyz sẵn sàng với backend nhúng giả (trễ --latency mỗi lô).
+STARTUP_PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.EMBED_RATE_LIMITER = app.TokenBucket(0, 1)
+app.start_warmup()
+client = app.app.test_client()
+while client.get('/readyz').status_code != 200:
+    time.sleep(0.005)
+ready = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'ready_seconds': ready - start,
+                  'chunks': app.STARTUP_STATUS['chunks'], 'rag': app.STARTUP_STATUS['rag']}))
+'''
+
+
+def _import_profile(env, cwd, top):
+    # python -X importtime: thời gian tích lũy (µs) của các module import trực tiếp từ app.py
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    # importtime in module con trước module cha; các dòng lùi 1 cấp ngay trước dòng "app" là con của nó
+    modules, children = [], []
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+        if not match:
+            continue
+        depth = (len(match.group(3)) - 1) // 2
+        if depth == 0:
+            if match.group(4) == 'app':
+                modules = children
+            children = []
+        elif depth == 1:
+            children.append({'module': match.group(4), 'cumulative_ms': round(int(match.group(2)) / 1000, 1)})
+    modules.sort(key=lambda m: -m['cumulative_ms'])
+    return modules[:top]
+
+
+def bench_startup(args):
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    pdfs = copy_pdfs(os.path.join(workdir, 'static'))
+    env = dict(os.environ, MODEL_BACKEND='fake', FAKE_EMBED_LATENCY=str(args.latency),
+               FLASK_SECRET_KEY='benchmark', STARTUP_WARMUP='0',
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'bench.db'),
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+
+    runs = []
+    for i in range(args.runs):
+        # Lần đầu: rag_cache trống (nhúng toàn bộ); các lần sau dùng lại chỉ mục trên đĩa
+        proc = subprocess.run([sys.executable, '-c', STARTUP_PROBE],
+                              cwd=workdir, env=env, capture_output=True, text=True, check=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result = {k: round(v, 4) if isinstance(v, float) else v for k, v in result.items()}
+        runs.append({'run': i, 'cache': 'cold' if i == 0 else 'warm', **result})
+    return {
+        'benchmark': 'startup',
+        'pdfs': pdfs,
+        'latency': args.latency,
+        'runs': runs,
+        'slowest_imports': _import_profile(env, workdir, args.top),
+    }
+
+
+TOPICS = ['tam giác vuông', 'số hữu tỉ', 'tỉ lệ thuận', 'phương trình bậc nhất', 'định lý Pythagore',
+          'hai góc đối đỉnh', 'lũy thừa', 'căn bậc hai', 'đường trung trực', 'biểu đồ đoạn thẳng']
+
+
+def chat_questions(count, repeat_ratio, seed):
+    # Một phần câu hỏi lặp lại câu trước đó (trúng cache), phần còn lại là câu mới
+    rng = np.random.default_rng(seed)
+    questions = []
+    for i in range(count):
+        if questions and rng.random() < repeat_ratio:
+            questions.append(questions[int(rng.integers(len(questions)))])
+        else:
+            questions.append(f'Thầy giải thích giúp con {TOPICS[i % len(TOPICS)]}, bài số {i}?')
+    return questions
+
+
+def bench_chat(args):
+    app = load_app(pdf_copies=1)
+    app.MODEL = app.FakeBackend(embed_latency=args.embed_latency, per_item_latency=0,
+                                generate_latency=args.latency, seed=args.seed)
+    app.EMBED_RATE_LIMITER = app.TokenBucket(0, 1)
+    app.warmup()
+    app.MODEL.failure_rate = args.failure_rate  # chỉ áp dụng cho request, không cho lúc dựng chỉ mục
+
+    clients = []
+    for i in range(args.users):
+        client = app.app.test_client()
+        client.post('/register', data={'username': f'bench{i}', 'password': 'benchmark', 'name': f'Bench {i}'})
+        client.post('/login', data={'username': f'bench{i}', 'password': 'benchmark'})
+        clients.append(client)
+    questions = chat_questions(args.requests, args.repeat_ratio, args.seed)
+    path = '/chat/stream' if args.stream else '/chat'
+    latencies, first_bytes, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def run_user(u):
+        client = clients[u]
+        for question in questions[u::args.users]:
+            start = time.perf_counter()
+            response = client.post(path, json={'message': question}, buffered=False)
+            first, body = None, []
+            for data in response.response:
+                if first is None:
+                    first = time.perf_counter() - start
+                body.append(data if isinstance(data, bytes) else data.encode('utf-8'))
+            elapsed = time.perf_counter() - start
+            status = response.status_code
+            if args.stream and b'event: error' in b''.join(body):
+                status = 'stream_error'
+            response.close()
+            with lock:
+                latencies.append(elapsed)
+                first_bytes.append(first if first is not None else elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    calls_before = dict(app.MODEL.calls)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(run_user, range(args.users)))
+    elapsed = time.perf_counter() - start
+    return {
+        'benchmark': 'chat',
+        'endpoint': path,
+        'users': args.users,
+        'requests': args.requests,
+        'repeat_ratio': args.repeat_ratio,
+        'generate_latency': args.latency,
+        'failure_rate': args.failure_rate,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(args.requests / elapsed, 2),
+        'statuses': statuses,
+        'latency_ms': percentiles(latencies),
+        'first_byte_ms': percentiles(first_bytes),
+        'model_calls': {k: v - calls_before.get(k, 0) for k, v in app.MODEL.calls.items()},
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _http(port, method, path, body=None, headers=None, timeout=60):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.getheaders(), resp.read()
+    finally:
+        conn.close()
+
+
+def _wait_ready(port, proc, log_path, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            with open(log_path, encoding='utf-8', errors='replace') as f:
+                raise RuntimeError(f'gunicorn dừng (mã {proc.returncode}): {f.read()[-2000:]}')
+        try:
+            if _http(port, 'GET', '/readyz', timeout=2)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'gunicorn chưa sẵn sàng sau {timeout}s')
+
+
+def _login_cookie(port, username):
+    form = urllib.parse.urlencode({'username': username, 'password': 'benchmark', 'name': username})
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    _http(port, 'POST', '/register', form, headers)
+    _, response_headers, _ = _http(port, 'POST', '/login', form, headers)
+    for name, value in response_headers:
+        if name.lower() == 'set-cookie' and value.startswith('session='):
+            return value.split(';', 1)[0]
+    raise RuntimeError(f'Không đăng nhập được {username}')
+
+
+def _run_capacity(worker_class, args):
+    # Chạy gunicorn thật (theo gunicorn.conf.py) với backend giả, rồi cho args.clients client
+    # gửi /chat liên tục (vòng kín). Chỉ đếm các request kết thúc trong khoảng đo (sau warmup).
+    workdir = tempfile.mkdtemp(prefix=f'bench_capacity_{worker_class}_')
+    copy_pdfs(os.path.join(workdir, 'static'))
+    port = _free_port()
+    env = dict(os.environ, MODEL_BACKEND='fake', FLASK_SECRET_KEY='benchmark',
+               FAKE_GENERATE_LATENCY=str(args.latency), FAKE_EMBED_LATENCY=str(args.embed_latency),
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'bench.db'),
+               GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_THREADS=str(args.threads),
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    log_path = os.path.join(workdir, 'gunicorn.log')
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                                 '-b', f'127.0.0.1:{port}', 'app:app'],
+                                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        _wait_ready(port, proc, log_path)
+        cookies = [_login_cookie(port, f'capacity{i}') for i in range(args.users)]
+        lock = threading.Lock()
+        samples, outcomes = [], {}
+        measure_from = time.perf_counter() + args.warmup
+        stop_at = measure_from + args.duration
+
+        def client(i):
+            headers = {'Content-Type': 'application/json', 'Cookie': cookies[i % len(cookies)]}
+            j = 0
+            while time.perf_counter() < stop_at:
+                # Câu hỏi không lặp lại: mỗi request đều nhúng câu hỏi và sinh câu trả lời mới
+                body = json.dumps({'message': f'Thầy giải thích giúp con {TOPICS[(i + j) % len(TOPICS)]}, câu {i}-{j}?'})
+                start = time.perf_counter()
+                try:
+                    status, _, data = _http(port, 'POST', '/chat', body, headers, timeout=args.timeout)
+                    outcome = str(status)
+                    if status == 200 and 'hơi mệt' in data.decode('utf-8', 'replace'):
+                        outcome = 'fallback'  # bị MODEL_CLIENT từ chối (bận/ngắt mạch)
+                except OSError as e:
+                    outcome = type(e).__name__
+                end = time.perf_counter()
+                if measure_from <= end <= stop_at:
+                    with lock:
+                        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                        if outcome == '200':
+                            samples.append(end - start)
+                j += 1
+
+        for i in range(args.clients):
+            threading.Thread(target=client, args=(i,), daemon=True).start()
+        time.sleep(max(0.0, stop_at - time.perf_counter()))
+        ok = len(samples)
+        return {
+            'worker_class': worker_class,
+            'workers': args.workers,
+            'threads': args.threads if worker_class == 'gthread' else None,
+            'requests_per_second': round(ok / args.duration, 2),
+            # Định luật Little: số request /chat trung bình đang được phục vụ cùng lúc
+            'mean_in_flight': round(sum(samples) / args.duration, 1),
+            'outcomes': outcomes,
+            'latency_ms': percentiles(samples),
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def bench_capacity(args):
+    results = []
+    for worker_class in args.modes.split(','):
+        if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+            results.append({'worker_class': worker_class, 'skipped': 'chưa cài gevent'})
+            continue
+        try:
+            results.append(_run_capacity(worker_class, args))
+        except RuntimeError as e:
+            results.append({'worker_class': worker_class, 'error': str(e).splitlines()[-1:]})
+    return {
+        'benchmark': 'capacity',
+        'clients': args.clients,
+        'generate_latency': args.latency,
+        'embed_latency': args.embed_latency,
+        'duration': args.duration,
+        # Worker sync: trần lý thuyết = số worker / độ trễ mỗi request
+        'sync_ceiling_rps': round(args.workers / (args.latency + args.embed_latency), 2),
+        'results': results,
+    }
+
+
+class SyntheticChunks:
+    # Danh sách chunk ảo (không tốn bộ nhớ cho 1M đoạn văn)
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return f'Đoạn văn số {i}'
+
+
+def synthetic_meta(n, chunk_chars=800, chunks_per_page=3):
+    # (trang, start, end) cho n chunk liền nhau của một file ảo
+    starts = np.arange(n, dtype=np.int64) * chunk_chars
+    return np.stack([starts // (chunk_chars * chunks_per_page) + 1, starts, starts + chunk_chars], axis=1)
+
+
+def synthetic_texts(n, rng, words_per_chunk=30, filler=5000):
+    # Đoạn văn giả cho BM25: từ khóa trong TOPICS trộn với từ đệm ngẫu nhiên
+    words = sorted({w for topic in TOPICS for w in topic.split()}) + [f'tu{k}' for k in range(filler)]
+    picks = rng.integers(len(words), size=(n, words_per_chunk))
+    return [' '.join(words[k] for k in row) for row in picks]
+
+
+def clustered_vectors(n, dim, clusters, rng, block=65536):
+    # Vector đã chuẩn hóa, gom quanh `clusters` tâm (giống embedding thật hơn nhiễu đều)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    out = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        rows = centers[rng.integers(clusters, size=stop - start)]
+        rows += 0.6 * rng.standard_normal((stop - start, dim), dtype=np.float32)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        out[start:stop] = rows
+    return out, centers
+
+
+def bench_retrieval(args):
+    app = load_app()
+    app.MODEL = app.FakeBackend(dim=args.dim, embed_latency=0, per_item_latency=0)
+    app.EMBED_RATE_LIMITER = app.TokenBucket(0, 1)
+    rng = np.random.default_rng(args.seed)
+    modes = args.modes.split(',')
+    results = []
+    for n in [int(x) for x in args.sizes.split(',')]:
+        vectors, centers = clustered_vectors(n, args.dim, max(1, int(np.sqrt(n))), rng)
+        queries = centers[rng.integers(len(centers), size=args.queries)]
+        queries = queries + 0.6 * rng.standard_normal(queries.shape, dtype=np.float32)
+        texts = synthetic_texts(n, rng) if {'bm25', 'hybrid'} & set(modes) else None
+        exact_ids = None
+        bm25 = None
+        for kind in modes:
+            start = time.perf_counter()
+            if kind in ('bm25', 'hybrid'):
+                # hybrid = vector chính xác + BM25, gộp bằng RRF trong search_rag
+                bm25 = bm25 or app.BM25Index.build(texts)
+                index = app.VectorIndex(vectors, normalized=True)
+            elif kind == 'ivf':
+                index = app.IVFIndex(vectors, normalized=True)
+            else:
+                index = app.VectorIndex(vectors, normalized=True)
+            build = time.perf_counter() - start
+
+            search = []
+            recall = None
+            if kind == 'bm25':
+                for j in range(args.queries):
+                    t = time.perf_counter()
+                    bm25.search(TOPICS[j % len(TOPICS)], args.top_k)
+                    search.append(time.perf_counter() - t)
+            elif kind != 'hybrid':
+                for q in queries:
+                    t = time.perf_counter()
+                    index.search(q, args.top_k)
+                    search.append(time.perf_counter() - t)
+                ids, _ = index.search_batch(queries, args.top_k)
+                ids = [set(int(i) for i in row) for row in ids]
+                if exact_ids is None and kind == 'exact':
+                    exact_ids = ids
+                if exact_ids is not None:
+                    recall = round(float(np.mean([len(a & b) / len(b) for a, b in zip(ids, exact_ids)])), 4)
+
+            # Đầu-cuối qua retrieve_context (nhúng câu hỏi bằng FakeBackend không trễ, câu hỏi khác nhau)
+            app.RAG_RETRIEVAL = kind if kind in ('bm25', 'hybrid') else 'vector'
+            app.RAG_DATA = dict(app.RAG_DATA, chunks=texts or SyntheticChunks(n), embeddings=index.vectors,
+                                index=index, bm25=bm25, source_ids=np.zeros(n, dtype=np.int32),
+                                chunk_meta=synthetic_meta(n), source_names=['synthetic.pdf'],
+                                name=f'synthetic-{n}-{kind}', is_ready=True)
+            retrieve = []
+            for j in range(args.queries):
+                t = time.perf_counter()
+                app.retrieve_context(f'{TOPICS[j % len(TOPICS)]} câu {j} cỡ {n} {kind}', args.top_k)
+                retrieve.append(time.perf_counter() - t)
+            results.append({
+                'chunks': n,
+                'index': kind,
+                'build_seconds': round(build, 4),
+                'search_ms': percentiles(search) if search else None,
+                'retrieve_context_ms': percentiles(retrieve),
+                'recall_at_k': recall,
+            })
+            del index
+        del vectors, texts, bm25
+    return {'benchmark': 'retrieval', 'dim': args.dim, 'top_k': args.top_k, 'queries': args.queries, 'results': results}
+
+
+def bench_indexing(args):
+    app = load_app(pdf_copies=args.copies)
+    app.MODEL = app.FakeBackend(embed_latency=args.latency, per_item_latency=args.per_text_latency)
+    app.EMBED_RATE_LIMITER = app.TokenBucket(0, 1)
+    folder = app.app.config['UPLOAD_FOLDER']
+    results = []
+
+    def measure(name, fn):
+        calls = app.MODEL.calls['embed']
+        start = time.perf_counter()
+        outcome = fn()
+        results.append({
+            'scenario': name,
+            'seconds': round(time.perf_counter() - start, 4),
+            'embed_calls': app.MODEL.calls['embed'] - calls,
+            'outcome': outcome,
+            'chunks': len(app.RAG_DATA['chunks']),
+            'index': app.RAG_DATA['name'],
+        })
+
+    # 1. Lạnh: chưa có cache văn bản, cache embedding hay chỉ mục nào
+    measure('cold', lambda: app.initialize_rag_data(folder))
+    # 2. Mất chỉ mục nhưng còn cache văn bản PDF + cache embedding (vd. đổi định dạng chỉ mục)
+    shutil.rmtree(app.RAG_INDEX_DIR)
+    measure('caches_warm', lambda: app.initialize_rag_data(folder))
+    # 3. Khởi động lại khi chỉ mục trên đĩa còn khớp: chỉ mmap
+    measure('index_warm', lambda: app.initialize_rag_data(folder))
+    # 4. Upload thêm một PDF: chỉ nhúng file mới
+    source = sorted(f for f in os.listdir(folder) if f.endswith('.pdf'))[0]
+    shutil.copy2(os.path.join(folder, source), os.path.join(folder, 'bench_upload.pdf'))
+    measure('add_one_pdf', lambda: app.add_pdf_to_rag('bench_upload.pdf', folder))
+    return {'benchmark': 'indexing', 'pdfs': len(os.listdir(folder)), 'embed_latency': args.latency, 'results': results}
+
+
+def bench_all(args):
+    # Chạy lần lượt các benchmark trong process con (mỗi cái một thư mục tạm + import app riêng)
+    reports = {}
+    for name, quick_args in SUITE_QUICK.items():
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), name] + (quick_args if args.quick else []),
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            reports[name] = {'error': proc.stderr.strip().splitlines()[-1:]}
+            continue
+        reports[name] = json.loads(proc.stdout)
+    return {'benchmark': 'all', 'quick': args.quick, 'reports': reports}
+
+
+# Tham số thu nhỏ cho `all --quick` (kiểm tra nhanh trên laptop/CI)
+SUITE_QUICK = {
+    'chat': ['--users', '4', '--requests', '40', '--latency', '0.05'],
+    'retrieval': ['--sizes', '1000,10000,100000', '--queries', '50', '--modes', 'exact,ivf,bm25,hybrid'],
+    'format': ['--seconds', '0.5', '--extra-terms', '200', '--random-cases', '5000'],
+    'indexing': ['--copies', '3', '--latency', '0.01'],
+    'embedding': ['--texts', '200', '--latency', '0.01'],
+    'startup': ['--runs', '2'],
+    'capacity': ['--clients', '50', '--warmup', '3', '--duration', '5', '--latency', '0.5'],
+}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AI hỗ trợ toán với backend giả lập')
+    sub = parser.add_subparsers(dest='name', required=True)
+
+    p = sub.add_parser('chat', help='Độ trễ /chat (p50/p90/p99) với nhiều học sinh đồng thời')
+    p.add_argument('--users', type=int, default=8, help='Số học sinh gửi câu hỏi đồng thời')
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--latency', type=float, default=0.3, help='Độ trễ sinh câu trả lời của backend giả (giây)')
+    p.add_argument('--embed-latency', type=float, default=0.02)
+    p.add_argument('--repeat-ratio', type=float, default=0.3, help='Tỉ lệ câu hỏi lặp lại câu trước đó')
+    p.add_argument('--failure-rate', type=float, default=0.0)
+    p.add_argument('--stream', action='store_true', help='Đo /chat/stream thay vì /chat')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_chat)
+
+    p = sub.add_parser('capacity', help='Số request /chat đồng thời/giây của gunicorn theo loại worker (sync, gthread, gevent)')
+    p.add_argument('--modes', default='sync,gthread,gevent')
+    p.add_argument('--clients', type=int, default=200, help='Số client gửi /chat liên tục cùng lúc')
+    p.add_argument('--users', type=int, default=20, help='Số tài khoản học sinh (client dùng chung phiên)')
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--threads', type=int, default=64, help='Số luồng mỗi worker gthread')
+    p.add_argument('--latency', type=float, default=1.0, help='Độ trễ sinh câu trả lời của backend giả (giây)')
+    p.add_argument('--embed-latency', type=float, default=0.05)
+    p.add_argument('--warmup', type=float, default=5.0, help='Số giây đầu không tính (MODEL_CLIENT tăng dần giới hạn đồng thời)')
+    p.add_argument('--duration', type=float, default=15.0)
+    p.add_argument('--timeout', type=float, default=60.0, help='Timeout mỗi request phía client (giây)')
+    p.set_defaults(func=bench_capacity)
+
+    p = sub.add_parser('retrieval', help='retrieve_context theo kích thước corpus (exact, IVF, BM25, hybrid)')
+    p.add_argument('--sizes', default='1000,10000,100000,1000000')
+    p.add_argument('--dim', type=int, default=256, help='Số chiều vector (text-embedding-004 là 768; 1M x 768 cần ~3GB RAM)')
+    p.add_argument('--queries', type=int, default=200)
+    p.add_argument('--top-k', type=int, default=3)
+    p.add_argument('--modes', default='exact,ivf', help='Danh sách exact,ivf,bm25,hybrid (bm25 tách từ bằng Python, chậm khi 1M đoạn)')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser('indexing', help='Thời gian dựng chỉ mục RAG: lạnh, cache ấm, chỉ mục có sẵn, thêm 1 PDF')
+    p.add_argument('--copies', type=int, default=10, help='Số bản sao của mỗi PDF mẫu')
+    p.add_argument('--latency', type=float, default=0.05, help='Độ trễ mỗi lô nhúng (giây)')
+    p.add_argument('--per-text-latency', type=float, default=0.0005)
+    p.set_defaults(func=bench_indexing)
+
+    p = sub.add_parser('embedding', help='Throughput của embed_with_retry')
+    p.add_argument('--texts', type=int, default=500)
+    p.add_argument('--latency', type=float, default=0.05, help='Độ trễ mỗi request (giây)')
+    p.add_argument('--per-text-latency', type=float, default=0.0005)
+    p.add_argument('--dim', type=int, default=768)
+    p.add_argument('--batch-size', type=int, default=100)
+    p.add_argument('--workers', type=int, default=4)
+    p.set_defaults(func=bench_embedding)
+
+    p = sub.add_parser('format', help='Kiểm tra golden và đo throughput của format_response')
+    p.add_argument('--seconds', type=float, default=2.0, help='Thời gian đo cho mỗi cấu hình')
+    p.add_argument('--extra-terms', type=int, default=500)
+    p.add_argument('--random-cases', type=int, default=50000,
+                   help='Số câu trả lời ngẫu nhiên để so với bản cũ và kiểm tra StreamingFormatter')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_format)
+
+    p = sub.add_parser('startup', help='Thời gian import app và thời gian tới khi /readyz sẵn sàng')
+    p.add_argument('--runs', type=int, default=3, help='Lần 1 lạnh (nhúng lại), các lần sau dùng chỉ mục trên đĩa')
+    p.add_argument('--latency', type=float, default=0.05, help='Độ trễ mỗi lô nhúng giả (giây)')
+    p.add_argument('--top', type=int, default=10, help='Số module import chậm nhất được liệt kê')
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('all', help='Chạy toàn bộ benchmark, gộp kết quả vào một file JSON')
+    p.add_argument('--quick', action='store_true', help='Dùng tham số nhỏ (xem SUITE_QUICK)')
+    p.set_defaults(func=bench_all)
+
+    for p in sub.choices.values():
+        p.add_argument('--out', help='Ghi kết quả JSON ra file thay vì stdout')
+
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None  # load_app() đổi thư mục làm việc
+    # Log của app (print) sang stderr để stdout chỉ còn JSON; không trả stdout lại vì luồng nền
+    # của app (hàng đợi đánh giá) có thể còn in sau khi benchmark xong
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    result = args.func(args)
+    report = json.dumps({**result, 'meta': metadata()}, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    else:
+        stdout.write(report + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
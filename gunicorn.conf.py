@@ -0,0 +1,36 @@
+# Cấu hình gunicorn cho app.py (Procfile: gunicorn -c gunicorn.conf.py app:app).
+# Một request /chat chủ yếu chờ mạng: nhúng câu hỏi, sinh câu trả lời, và thỉnh thoảng đánh
+# giá nền. Vì vậy mỗi worker nên giữ được nhiều request cùng lúc thay vì một request/worker:
+# - gthread (mặc định): GUNICORN_THREADS luồng/worker, không cần thư viện thêm.
+# - gevent (GUNICORN_WORKER_CLASS=gevent): mỗi request một greenlet, tối đa
+#   GUNICORN_CONNECTIONS/worker. app.py tự chuyển Gemini sang REST (xem get_genai), chờ
+#   rag_build_lock bằng cách thử lại thay vì flock chặn, đọc PDF tuần tự và nhường event loop
+#   trong các vòng lặp CPU dài; psycopg2 được vá bằng psycogreen trong post_fork. Dựng chỉ mục
+#   lớn vẫn chiếm event loop từng đoạn, nên chỉ bật khi chỉ mục đã dựng sẵn trên đĩa.
+# - sync: một request/worker như trước, chỉ để so sánh (benchmarks/run.py capacity).
+# Số lời gọi mô hình song song thực tế do MODEL_CLIENT điều chỉnh (MODEL_MAX_CONCURRENCY).
+import multiprocessing
+import os
+
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Chỉ mục RAG được mmap dùng chung, nên thêm worker chủ yếu tốn RAM cho interpreter
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+# gunicorn tự đổi sync sang gthread khi threads > 1, nên chỉ đặt threads cho gthread
+threads = int(os.getenv('GUNICORN_THREADS', 64)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', 1000))
+# Lớn hơn MODEL_STREAM_TIMEOUT để /chat/stream dài không bị coi là worker treo
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        server.log.warning("psycogreen chưa được cài: truy vấn PostgreSQL sẽ chặn cả worker gevent")
+        return
+    patch_psycopg()
@@ -0,0 +1,42 @@
+"""add owner to danhgia_jobs
+
+Revision ID: 493e7bac4cb5
+Revises: f226d002289e
+Create Date: 2026-10-17 23:00:29.961626
+
+Cột owner ("máy:pid") cho biết tiến trình nào đang chạy job đánh giá, để
+recover_evaluation_jobs không giành lại job của worker anh em còn sống.
+CSDL tạo mới bằng create_all đã có cột này.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '493e7bac4cb5'
+down_revision = 'f226d002289e'
+branch_labels = None
+depends_on = None
+
+
+def _columns():
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('danhgia_jobs'):
+        return None
+    return {c['name'] for c in sa.inspect(bind).get_columns('danhgia_jobs')}
+
+
+def upgrade():
+    columns = _columns()
+    if columns is None or 'owner' in columns:
+        return
+    with op.batch_alter_table('danhgia_jobs') as batch_op:
+        batch_op.add_column(sa.Column('owner', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    columns = _columns()
+    if columns is None or 'owner' not in columns:
+        return
+    with op.batch_alter_table('danhgia_jobs') as batch_op:
+        batch_op.drop_column('owner')
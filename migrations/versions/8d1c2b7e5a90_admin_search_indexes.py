@@ -0,0 +1,57 @@
+"""admin search indexes
+
+Revision ID: 8d1c2b7e5a90
+Revises: 493e7bac4cb5
+Create Date: 2026-10-17 23:01:50.522818
+
+Trang admin phân trang keyset theo (name, id)/(level, id): dòng có name/level NULL sẽ lọt khỏi
+phép so sánh bộ giá trị, nên điền giá trị mặc định cho chúng. Trên PostgreSQL thêm index GIN
+trigram cho tìm kiếm chuỗi con (ILIKE '%q%') theo tên đăng nhập và tên học sinh; cần extension
+pg_trgm (nếu tài khoản CSDL không được tạo extension thì bỏ qua index, tìm kiếm vẫn chạy nhưng
+quét tuần tự). CSDL trống (chưa có bảng) thì không làm gì: init_db tạo bảng và các index này.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d1c2b7e5a90'
+down_revision = '493e7bac4cb5'
+branch_labels = None
+depends_on = None
+
+TRGM_INDEXES = {
+    'ix_taikhoan_hocsinh_username_trgm': 'username',
+    'ix_taikhoan_hocsinh_name_trgm': 'name',
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('taikhoan_hocsinh'):
+        return
+    op.execute("UPDATE taikhoan_hocsinh SET name = '' WHERE name IS NULL")
+    op.execute("UPDATE taikhoan_hocsinh SET level = 'Đạt yêu cầu' WHERE level IS NULL")
+    if bind.dialect.name != 'postgresql':
+        return
+    try:
+        with bind.begin_nested():
+            bind.execute(sa.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    except sa.exc.DBAPIError as e:
+        print(f"⚠️ Không tạo được extension pg_trgm, bỏ qua index tìm kiếm: {e}")
+        return
+    existing = {index['name'] for index in sa.inspect(bind).get_indexes('taikhoan_hocsinh')}
+    for name, column in TRGM_INDEXES.items():
+        if name not in existing:
+            op.create_index(name, 'taikhoan_hocsinh', [column], postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or not sa.inspect(bind).has_table('taikhoan_hocsinh'):
+        return
+    existing = {index['name'] for index in sa.inspect(bind).get_indexes('taikhoan_hocsinh')}
+    for name in TRGM_INDEXES:
+        if name in existing:
+            op.drop_index(name, table_name='taikhoan_hocsinh')
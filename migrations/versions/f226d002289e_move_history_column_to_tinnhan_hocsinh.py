@@ -0,0 +1,100 @@
+"""move history column to tinnhan_hocsinh
+
+Revision ID: f226d002289e
+Revises:
+Create Date: 2026-10-17 22:59:12.129195
+
+Chuyển cột history cũ của taikhoan_hocsinh (các câu hỏi "👧 Học sinh: ..." nối bằng \n) sang
+bảng tinnhan_hocsinh, mỗi câu một dòng, rồi xóa cột. CSDL tạo mới bằng create_all không có
+cột history nên bản migration này không làm gì. Chạy trước khi khởi động web
+(Procfile: release), nên chưa học sinh nào có tin nhắn mới.
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f226d002289e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+STUDENT_PREFIX = "👧 Học sinh:"
+BATCH_SIZE = 1000
+
+messages = sa.table(
+    'tinnhan_hocsinh',
+    sa.column('user_id', sa.Integer),
+    sa.column('role', sa.String),
+    sa.column('created_at', sa.DateTime),
+    sa.column('text', sa.Text),
+)
+
+
+def _has_history_column():
+    # CSDL trống (chưa chạy init_db): chưa có bảng thì cũng chưa có gì để chuyển
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('taikhoan_hocsinh'):
+        return False
+    return any(c['name'] == 'history' for c in inspector.get_columns('taikhoan_hocsinh'))
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not _has_history_column():
+        return
+    if not sa.inspect(bind).has_table('tinnhan_hocsinh'):
+        op.create_table(
+            'tinnhan_hocsinh',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('taikhoan_hocsinh.id', ondelete='CASCADE'), nullable=False),
+            sa.Column('role', sa.String(length=10), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('text', sa.Text(), nullable=False),
+        )
+        op.create_index('ix_tinnhan_hocsinh_user_role_id', 'tinnhan_hocsinh', ['user_id', 'role', 'id'])
+
+    # Học sinh đã có tin nhắn thì giữ nguyên (migration bị chạy lại sau khi đã chuyển một phần)
+    migrated = {row[0] for row in bind.execute(sa.text('SELECT DISTINCT user_id FROM tinnhan_hocsinh'))}
+    rows = bind.execute(sa.text(
+        "SELECT id, history FROM taikhoan_hocsinh WHERE history IS NOT NULL AND history != '' ORDER BY id"
+    )).all()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    batch = []
+    for user_id, history in rows:
+        if user_id in migrated:
+            continue
+        for line in history.split('\n'):
+            line = line.strip()
+            if line.startswith(STUDENT_PREFIX):
+                line = line[len(STUDENT_PREFIX):].strip()
+            if line:
+                batch.append({'user_id': user_id, 'role': 'student', 'created_at': now, 'text': line})
+        if len(batch) >= BATCH_SIZE:
+            op.bulk_insert(messages, batch)
+            batch = []
+    if batch:
+        op.bulk_insert(messages, batch)
+
+    # batch_alter_table: SQLite không có DROP COLUMN đầy đủ, alembic tạo lại bảng
+    with op.batch_alter_table('taikhoan_hocsinh') as batch_op:
+        batch_op.drop_column('history')
+
+
+def downgrade():
+    # Dựng lại cột history từ các câu hỏi của học sinh (đúng định dạng cũ). Tin nhắn được giữ
+    # nguyên trong tinnhan_hocsinh; câu trả lời của thầy/cô chưa bao giờ nằm trong cột cũ.
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('taikhoan_hocsinh') or _has_history_column():
+        return
+    with op.batch_alter_table('taikhoan_hocsinh') as batch_op:
+        batch_op.add_column(sa.Column('history', sa.Text(), nullable=True, server_default=''))
+    histories = {}
+    for user_id, line in bind.execute(sa.text(
+            "SELECT user_id, text FROM tinnhan_hocsinh WHERE role = 'student' ORDER BY user_id, id")):
+        histories.setdefault(user_id, []).append(f"{STUDENT_PREFIX} {line.strip()}")
+    for user_id, lines in histories.items():
+        bind.execute(sa.text('UPDATE taikhoan_hocsinh SET history = :history WHERE id = :id'),
+                     {'history': '\n'.join(lines), 'id': user_id})
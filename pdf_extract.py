@@ -0,0 +1,18 @@
+# Trích xuất văn bản PDF trong tiến trình con (process pool của app._map_page_ranges).
+# Module nhỏ, không import app.py: pool chạy bằng forkserver/spawn, tiến trình con chỉ cần
+# import module này thay vì chạy lại toàn bộ khởi tạo của app (CSDL, RAG, luồng nền).
+
+
+def extract_page_range(pdf_path, start, stop):
+    # -> (danh sách văn bản từng trang, đọc thành công hay không)
+    pages = []
+    try:
+        with open(pdf_path, 'rb') as f:
+            import PyPDF2
+            reader = PyPDF2.PdfReader(f)
+            for i in range(start, min(stop, len(reader.pages))):
+                pages.append(reader.pages[i].extract_text() or "")
+        return pages, True
+    except Exception as e:
+        print(f"⚠️ Lỗi khi đọc PDF {pdf_path}: {e}")
+        return pages, False